@@ -3,19 +3,36 @@ import os
 import re
 import sys
 import json
+import math
 import shlex
+import random
+import sqlite3
 import argparse
 import subprocess
-import urllib.request
-
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from multiprocessing import cpu_count
 from pathlib import Path
+from typing import TypedDict, Iterable, Iterator, Optional, Any
+from timeit import default_timer
+
+from ffmpegmulti import iter_audio_files, percentile
 
 NOTE_TYPE = "JP Mining Note"
 AUDIO_FIELD = "SentenceAudio"
 MEDIA_DIR = "/home/austin/.local/share/Anki2/Japanese/collection.media"
 
 BASE_QUERY = f'"note:{NOTE_TYPE}" -{AUDIO_FIELD}:'
-FFMPEG_CMD = f'ffmpeg -i "%s" -af volumedetect -f null -'
+ANKI_CONNECT = "http://localhost:8765"
+# notes per notesInfo call, and notesInfo calls grouped into one request (with the multi action)
+NOTES_INFO_PAGE = 250
+PAGES_PER_REQUEST = 4
+NOTE_CACHE = "temp/analyze_sentence_audio/note_cache.sqlite"
+FFMPEG_CMD = f'ffmpeg -hide_banner -nostdin -i "%s" -vn -sn -dn -af volumedetect -f null -'
+# width of the bins of the mean volume histogram, in dB
+HISTOGRAM_BIN = 3
+HISTOGRAM_WIDTH = 50
 
 rx_AUDIO_FILE = re.compile(r'\[sound:(.+)\]')
 # [Parsed_volumedetect_0 @ 0x565118092980] n_samples: 280287
@@ -26,15 +43,23 @@ rx_AUDIO_FILE = re.compile(r'\[sound:(.+)\]')
 # [Parsed_volumedetect_0 @ 0x565118092980] histogram_6db: 42
 # [Parsed_volumedetect_0 @ 0x565118092980] histogram_7db: 127
 # [Parsed_volumedetect_0 @ 0x565118092980] histogram_8db: 270
+rx_N_SAMPLES = re.compile(r'n_samples: (\d+)')
 rx_MEAN_VOLUME = re.compile(r'mean_volume: (-?\d+(\.\d+)?) dB')
-rx_MAX_VOLUME = re.compile(r'max_volume: (-?\d+(\.\d+)) dB')
+rx_MAX_VOLUME = re.compile(r'max_volume: (-?\d+(\.\d+)?) dB')
+
+
+class VolumeStats(TypedDict):
+    file: str
+    n_samples: int
+    # dB (relative to full scale) of the mean power, and of the peak sample
+    mean_volume: float
+    max_volume: float
+
 
 def request(action, **params):
     return {'action': action, 'params': params, 'version': 6}
 
-def invoke(action, **params):
-    requestJson = json.dumps(request(action, **params)).encode('utf-8')
-    response = json.load(urllib.request.urlopen(urllib.request.Request('http://localhost:8765', requestJson)))
+def check_response(response):
     if len(response) != 2:
         raise Exception('response has an unexpected number of fields')
     if 'error' not in response:
@@ -45,6 +70,129 @@ def invoke(action, **params):
         raise Exception(response['error'])
     return response['result']
 
+
+class AnkiConnect:
+    """
+    AnkiConnect client keeping a single keep-alive HTTP connection for all of its calls
+    """
+
+    def __init__(self, url: str = ANKI_CONNECT, timeout: float = 60):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 80
+        self.path = parts.path or "/"
+        self.timeout = timeout
+        self.connection: Optional[http.client.HTTPConnection] = None
+        self.requests = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def post(self, payload) -> Any:
+        body = json.dumps(payload).encode("utf-8")
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request("POST", self.path, body, {"Content-Type": "application/json"})
+                response = self.connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # the server closed the idle connection, a new one is opened once
+                self.close()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            self.requests += 1
+            return json.loads(data)
+
+    def invoke(self, action, **params):
+        return check_response(self.post(request(action, **params)))
+
+    def multi(self, calls: list[tuple[str, dict]]) -> list:
+        """
+        runs the (action, params) calls in a single request, returns their results in order
+        """
+        results = self.invoke("multi", actions=[request(action, **params) for action, params in calls])
+        # with version 6, every result is wrapped in its own {"result": ..., "error": ...}
+        return [check_response(result) if isinstance(result, dict) and set(result) == {"result", "error"} else result
+                for result in results]
+
+    def notes_info(self, notes: list[int]) -> Iterator[list[dict]]:
+        """
+        notesInfo of the notes, NOTES_INFO_PAGE notes per call and PAGES_PER_REQUEST calls per request,
+        yields the info one request at a time
+        """
+        pages = [notes[i:i + NOTES_INFO_PAGE] for i in range(0, len(notes), NOTES_INFO_PAGE)]
+        for i in range(0, len(pages), PAGES_PER_REQUEST):
+            results = self.multi([("notesInfo", {"notes": page}) for page in pages[i:i + PAGES_PER_REQUEST]])
+            yield [info for result in results for info in result]
+
+
+class NoteCache:
+    """
+    sentence audio file of every note seen before (None if the note has none), keyed by note id
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS notes (note_id INTEGER PRIMARY KEY, audio_file TEXT)")
+        self.conn.commit()
+
+    def get_many(self, notes: list[int]) -> dict[int, Optional[str]]:
+        found = {}
+        # below SQLite's limit on the number of parameters
+        for i in range(0, len(notes), 900):
+            chunk = notes[i:i + 900]
+            rows = self.conn.execute(
+                f"SELECT note_id, audio_file FROM notes WHERE note_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            found.update(rows)
+        return found
+
+    def put_many(self, entries: dict[int, Optional[str]]):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO notes VALUES (?, ?)", entries.items())
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM notes")
+
+
+def get_audio_file(note_info: dict) -> Optional[str]:
+    search_result = rx_AUDIO_FILE.search(note_info["fields"][AUDIO_FIELD]["value"].strip())
+    return None if search_result is None else search_result.group(1)
+
+
+def get_sentence_audio_files(anki: AnkiConnect, tag: str, cache: Optional[NoteCache]) -> list[str]:
+    """
+    sentence audio files of the notes with the tag. Only the notes missing from the cache are fetched.
+    """
+    query = f'{BASE_QUERY} "tag:{tag}"'
+    notes: list[int] = anki.invoke("findNotes", query=query)
+    print("Found", len(notes), "notes.")
+
+    audio_files = {} if cache is None else cache.get_many(notes)
+    missing = [note for note in notes if note not in audio_files]
+    if missing:
+        print(f"Getting note info of {len(missing)} notes ({len(notes) - len(missing)} cached)...")
+    for notes_info in anki.notes_info(missing):
+        fetched = {note_info["noteId"]: get_audio_file(note_info) for note_info in notes_info}
+        audio_files.update(fetched)
+        if cache is not None:
+            cache.put_many(fetched)
+
+    return [os.path.join(MEDIA_DIR, audio_files[note]) for note in notes if audio_files.get(note) is not None]
+
 def run_cmd(cmd):
     parsed_cmd = cmd if sys.platform == "win32" else shlex.split(cmd)
     return subprocess.run(
@@ -56,13 +204,26 @@ def get_args():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
 
-    sentence = subparsers.add_parser('sentence')
+    # options of both modes
+    survey = argparse.ArgumentParser(add_help=False)
+    survey.add_argument("--jobs", type=int, default=cpu_count(), help="number of ffmpeg processes running at once")
+    survey.add_argument("--sample", type=int, default=None,
+                        help="measure a uniform random sample of this many files (reservoir sampling)")
+    survey.add_argument("--seed", type=int, default=None, help="seed of the random sample")
+
+    sentence = subparsers.add_parser('sentence', parents=[survey])
     sentence.add_argument("tag", type=str)
+    sentence.add_argument("--anki-connect", type=str, default=ANKI_CONNECT, help="AnkiConnect URL")
+    sentence.add_argument("--no-cache", default=False, action='store_true',
+                          help="neither read nor write the cache of the notes' audio files")
+    sentence.add_argument("--clear-cache", default=False, action='store_true',
+                          help="empties the cache of the notes' audio files before running (e.g. after editing the notes)")
     sentence.set_defaults(type="sentence")
 
-    local_audio = subparsers.add_parser('local_audio')
+    local_audio = subparsers.add_parser('local_audio', parents=[survey])
     local_audio.add_argument("folder", type=str)
-    local_audio.add_argument("ratio", type=float, default="1000")
+    local_audio.add_argument("ratio", type=float, nargs="?", default=None,
+                             help="measure about 1 in RATIO files, picked at random as the folder is walked")
     local_audio.set_defaults(type="local_audio")
 
     return parser.parse_args()
@@ -79,66 +240,138 @@ def get_ffmpeg_number(rx, output):
     return float_result
 
 
-def main():
-    args = get_args()
+def volumedetect(file: str) -> Optional[VolumeStats]:
+    output = run_cmd(FFMPEG_CMD % file).stderr # WHY does it use stderr?
+    mean_volume = get_ffmpeg_number(rx_MEAN_VOLUME, output)
+    max_volume = get_ffmpeg_number(rx_MAX_VOLUME, output)
+    n_samples = get_ffmpeg_number(rx_N_SAMPLES, output)
+    # undecodable, or digital silence (-inf dB)
+    if mean_volume is None or max_volume is None or not n_samples:
+        return None
+    return {"file": file, "n_samples": int(n_samples), "mean_volume": mean_volume, "max_volume": max_volume}
 
-    # NOTE: dB is a logarithmic. A simple average is likely not the correct way of measuring average dB.
-    avg_max = 0
-    avg_max_n = 0
-    avg_mean = 0
-    avg_mean_n = 0
 
-    if args.type == "sentence":
-        query = f'{BASE_QUERY} "tag:{args.tag}"'
-        notes: list[int] = invoke("findNotes", query=query)
-        print("Found", len(notes), "notes.")
-        if len(notes) == 0:
-            return
-        print("Getting note info...")
-        notes_info = invoke("notesInfo", notes=notes)
-        for note_info in notes_info:
-            sentence_audio = note_info["fields"][AUDIO_FIELD]["value"]
-            search_result = rx_AUDIO_FILE.search(sentence_audio.strip())
-            if search_result is None:
-                continue
-            audio_file = search_result.group(1)
-            cmd_result = run_cmd(FFMPEG_CMD % os.path.join(MEDIA_DIR, audio_file))
-            output = cmd_result.stderr # WHY does it use stderr?
+def bernoulli_sample(items: Iterable[str], ratio: float, rng: random.Random) -> Iterator[str]:
+    """
+    keeps every item with a probability of 1 / ratio, without waiting for the end of the input
+    """
+    for item in items:
+        if rng.random() * ratio < 1:
+            yield item
+
+
+def reservoir_sample(items: Iterable[str], size: int, rng: random.Random) -> list[str]:
+    """
+    uniform random sample of size items out of an input of unknown length, in one pass (algorithm R)
+    """
+    sample: list[str] = []
+    for i, item in enumerate(items):
+        if i < size:
+            sample.append(item)
+        else:
+            j = rng.randrange(i + 1)
+            if j < size:
+                sample[j] = item
+    return sample
+
+
+def survey(files: Iterable[str], jobs: int) -> Iterator[tuple[str, Optional[VolumeStats]]]:
+    """
+    runs volumedetect on the files with jobs processes at once, yields (file, stats) as they finish.
+    Files are only taken from the input when a worker is free, so a lazy input is never read ahead.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending: dict[Future, str] = {}
+        files = iter(files)
+        while True:
+            for file in files:
+                pending[executor.submit(volumedetect, file)] = file
+                if len(pending) >= jobs:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
 
-            mean_result_float = get_ffmpeg_number(rx_MEAN_VOLUME, output)
-            if mean_result_float is not None:
-                avg_mean += mean_result_float
-                avg_mean_n += 1
 
-            max_result_float = get_ffmpeg_number(rx_MAX_VOLUME, output)
-            if max_result_float is not None:
-                avg_max += max_result_float
-                avg_max_n += 1
+def power_to_db(power: float) -> float:
+    return 10 * math.log10(power) if power > 0 else -math.inf
 
-            print(audio_file, mean_result_float, max_result_float)
 
-        print("avg max:", avg_max / avg_max_n, "avg mean:", avg_mean / avg_mean_n)
+def db_to_power(db: float) -> float:
+    return 10 ** (db / 10)
 
+
+def print_histogram(values: list[float]):
+    low = math.floor(min(values) / HISTOGRAM_BIN) * HISTOGRAM_BIN
+    counts: dict[int, int] = {}
+    for value in values:
+        b = int((value - low) // HISTOGRAM_BIN)
+        counts[b] = counts.get(b, 0) + 1
+    peak = max(counts.values())
+    for b in range(max(counts) + 1):
+        count = counts.get(b, 0)
+        bar = "#" * math.ceil(count / peak * HISTOGRAM_WIDTH)
+        print(f"  {low + b * HISTOGRAM_BIN:6.0f} dB {count:7} {bar}")
+
+
+def print_report(results: list[VolumeStats], failed: int, elapsed: float):
+    print(f"\nfiles: {len(results)} measured, {failed} without a measurement, in {elapsed:.1f}s")
+    if not results:
+        return
+
+    # dB are logarithmic: averages are taken over the power and converted back to dB
+    total_samples = sum(r["n_samples"] for r in results)
+    pooled = sum(db_to_power(r["mean_volume"]) * r["n_samples"] for r in results) / total_samples
+    per_file = sum(db_to_power(r["mean_volume"]) for r in results) / len(results)
+    print(f"mean volume: {power_to_db(pooled):.1f} dB over all samples, {power_to_db(per_file):.1f} dB averaged per file")
+    print(f"max volume: {max(r['max_volume'] for r in results):.1f} dB")
+
+    for name in ["mean_volume", "max_volume"]:
+        values = sorted(r[name] for r in results)
+        print(f"{name} percentiles: " + "  ".join(f"p{p}={percentile(values, p):.1f}" for p in [1, 5, 25, 50, 75, 95, 99]))
+
+    print("mean_volume histogram:")
+    print_histogram([r["mean_volume"] for r in results])
+
+
+def main():
+    args = get_args()
+    rng = random.Random(args.seed)
+
+    if args.type == "sentence":
+        cache = None if args.no_cache else NoteCache(NOTE_CACHE)
+        if cache is not None and args.clear_cache:
+            cache.clear()
+        anki = AnkiConnect(args.anki_connect)
+        try:
+            files = get_sentence_audio_files(anki, args.tag, cache)
+        finally:
+            anki.close()
+        print(f"{len(files)} audio files, {anki.requests} AnkiConnect requests.")
+        if len(files) == 0:
+            return
     else: # local_audio
-        folder = Path(args.folder)
-        ratio = args.ratio
-        for i, path in enumerate(folder.rglob("*")):
-            if i % ratio == 0:
-                cmd_result = run_cmd(FFMPEG_CMD % str(path))
-                output = cmd_result.stderr # WHY does it use stderr?
-
-                mean_result_float = get_ffmpeg_number(rx_MEAN_VOLUME, output)
-                if mean_result_float is not None:
-                    avg_mean += mean_result_float
-                    avg_mean_n += 1
-
-                max_result_float = get_ffmpeg_number(rx_MAX_VOLUME, output)
-                if max_result_float is not None:
-                    avg_max += max_result_float
-                    avg_max_n += 1
-
-                print(path, mean_result_float, max_result_float)
-        print("avg max:", avg_max / avg_max_n, "avg mean:", avg_mean / avg_mean_n, "files:", avg_max_n+avg_mean_n/2)
+        files = (str(file) for file in iter_audio_files(Path(args.folder), "analyze_sentence_audio"))
+        if args.ratio is not None:
+            files = bernoulli_sample(files, args.ratio, rng)
+
+    if args.sample is not None:
+        files = reservoir_sample(files, args.sample, rng)
+
+    start = default_timer()
+    results: list[VolumeStats] = []
+    failed = 0
+    for file, stats in survey(files, max(1, args.jobs)):
+        if stats is None:
+            failed += 1
+            print(file, None, None)
+            continue
+        results.append(stats)
+        print(file, stats["mean_volume"], stats["max_volume"])
+
+    print_report(results, failed, default_timer() - start)
 
 
 if __name__ == "__main__":
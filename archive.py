@@ -0,0 +1,134 @@
+"""
+Streams a collection (e.g. output/opus/user_files) into a reproducible .tar.xz / .tar.zst while it is still being built.
+
+The archive holds the same tree as `tar --numeric-owner --sort=name -C output/opus -cf ... user_files`,
+but with fixed owners, modes and mtimes so the same inputs always give the same bytes.
+
+Every top-level entry of the collection (forvo_files, jpod_files, jmdict_forms.json, ...) is a section.
+A section listed in --sections is only archived once READY_DIR/<section> exists, which the build script
+creates when the section is complete. Sections are written in sorted order as soon as they and every
+section before them are ready, so compressing the first sources overlaps with encoding the later ones.
+Entries that are not listed are considered ready from the start.
+
+    python archive.py output/opus/user_files local-yomichan-audio-collection-opus.tar.xz \\
+        --ready-dir temp/archive_ready --sections forvo_files jpod_files
+"""
+
+import os
+import time
+import stat
+import tarfile
+import argparse
+import subprocess
+from pathlib import Path
+from timeit import default_timer
+
+# compressor name -> command reading the tar from stdin and writing to stdout (multithreaded)
+# the xz block size is fixed so the output doesn't depend on the number of threads
+COMPRESSORS = {
+    "xz": ["xz", "-T0", "--block-size=24MiB", "-c"],
+    "zstd": ["zstd", "-T0", "-q", "-c", "-19"],
+    "none": None,
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("collection", type=str, help="directory archived as the top-level entry, e.g. output/opus/user_files")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--compressor", choices=list(COMPRESSORS), default="xz")
+    parser.add_argument("--sections", nargs="*", default=[], help="top-level entries that are archived once they are ready")
+    parser.add_argument("--ready-dir", type=str, default=None, help="directory of the ready markers of --sections")
+    parser.add_argument("--mtime", type=int, default=int(os.environ.get("SOURCE_DATE_EPOCH", 0)),
+                        help="mtime of every entry (default: $SOURCE_DATE_EPOCH, or 0)")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    return parser.parse_args()
+
+
+def make_info(name: str, st: os.stat_result, mtime: int) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.type = tarfile.REGTYPE
+        info.mode = 0o644
+        info.size = st.st_size
+    return info
+
+
+def add_tree(tar: tarfile.TarFile, path: Path, name: str, mtime: int) -> int:
+    """
+    adds path (recursively, sorted by name like tar --sort=name), returns the number of bytes of file data
+    """
+    st = path.stat()
+    info = make_info(name, st, mtime)
+    if info.isdir():
+        tar.addfile(info)
+        total = 0
+        for child in sorted(os.listdir(path)):
+            # partial outputs of ffmpegmulti / build_indexes
+            if child.endswith(".tmp"):
+                continue
+            total += add_tree(tar, path / child, f"{name}/{child}", mtime)
+        return total
+    with open(path, "rb") as f:
+        tar.addfile(info, f)
+    return info.size
+
+
+def main():
+    args = get_args()
+    collection = Path(args.collection)
+    if args.sections and args.ready_dir is None:
+        raise RuntimeError("--sections requires --ready-dir")
+
+    def is_ready(section):
+        return section not in args.sections or os.path.exists(os.path.join(args.ready_dir, section))
+
+    partial = args.output + ".tmp"
+    start = default_timer()
+    with open(partial, "wb") as out:
+        compressor = None
+        stream = out
+        if COMPRESSORS[args.compressor] is not None:
+            compressor = subprocess.Popen(COMPRESSORS[args.compressor], stdin=subprocess.PIPE, stdout=out)
+            stream = compressor.stdin
+
+        # "w|": a stream, so the compressor gets the data as it is written
+        with tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            tar.addfile(make_info(collection.name, collection.stat(), args.mtime))
+            done = set()
+            while True:
+                names = sorted(set(args.sections) | set(os.listdir(collection)))
+                pending = [name for name in names if name not in done and not name.endswith(".tmp")]
+                if not pending:
+                    break
+                # only the next section in sorted order can be written, so the archive stays sorted
+                section = pending[0]
+                if done and section < max(done):
+                    raise RuntimeError(f"{section} appeared after later sections were archived, add it to --sections")
+                if not is_ready(section):
+                    time.sleep(args.poll_interval)
+                    continue
+                if not (collection / section).exists():
+                    raise RuntimeError(f"section marked as ready but missing: {collection / section}")
+                size = add_tree(tar, collection / section, f"{collection.name}/{section}", args.mtime)
+                done.add(section)
+                print(f"(archive) {args.output}: added {section} ({size / 1024 ** 2:.1f}MiB) "
+                      f"after {default_timer() - start:.1f}s", flush=True)
+
+        if compressor is not None:
+            compressor.stdin.close()
+            if compressor.wait() != 0:
+                raise RuntimeError(f"{args.compressor} failed ({compressor.returncode})")
+
+    os.replace(partial, args.output)
+    print(f"(archive) wrote {args.output} in {default_timer() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Benchmarks ffmpegmulti.py, jpod_index.py and parse_jmdict.py on a synthetic corpus.
+
+The corpus is generated offline with ffmpeg's lavfi sources and is fully deterministic
+(fixed seeds, bitexact encoders), so runs on different branches measure the same input:
+- forvo-like clips: sine + pink noise, with leading/trailing silence, varied lengths, as mp3/aac/wav
+- jpod-like "reading - term.mp3" files, with byte identical duplicates across jpod_files and jpod_alternate_files
+- a JMdict-shaped XML file
+
+Every script runs in its own work directory (the scripts use paths relative to the cwd).
+Results are written as JSON, and --compare fails if the throughput regressed:
+
+    python benchmark.py --sizes 100 1000 --output temp/benchmark/main.json
+    python benchmark.py --sizes 100 1000 --compare temp/benchmark/main.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from pathlib import Path
+from timeit import default_timer
+
+SCRIPT_PATH = Path(__file__).parent
+BENCHMARK_DIR = "temp/benchmark"
+CORPUS_VERSION = 1
+# --batch of the ffmpegmulti_cold_batch benchmark
+BATCH_SIZE = 16
+
+# (container extension, encoder arguments), weighted like the real sources
+CODECS = [
+    (".mp3", "-c:a libmp3lame -q:a 4"),
+    (".mp3", "-c:a libmp3lame -q:a 4"),
+    (".mp3", "-c:a libmp3lame -q:a 4"),
+    (".aac", "-c:a aac -b:a 64k"),
+    (".wav", "-c:a pcm_s16le"),
+]
+
+HIRAGANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをんがぎぐげござじずぜぞ"
+KANJI = "日本語学生先会社時間年人大小中上下山川田口目耳手足力気雨電車道店肉魚鳥花海空"
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500],
+                        help="number of audio files in each generated corpus")
+    parser.add_argument("--jmdict-entries-per-file", type=int, default=50,
+                        help="JMdict entries generated per audio file of the corpus size")
+    parser.add_argument("--jobs", type=int, default=cpu_count(), help="passed to ffmpegmulti.py")
+    parser.add_argument("--ffmpeg", type=str, default="ffmpeg", help="used to generate the corpus")
+    parser.add_argument("--only", choices=["ffmpegmulti", "jpod_index", "parse_jmdict"], nargs="+", default=None)
+    parser.add_argument("--output", type=str, default=f"{BENCHMARK_DIR}/results.json")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="previous results file; exits with 1 if any throughput dropped by more than --threshold")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed throughput regression in percent")
+    return parser.parse_args()
+
+
+def kana(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(HIRAGANA) for _ in range(length))
+
+
+def kanji(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(KANJI) for _ in range(length))
+
+
+def generate_clip(ffmpeg: str, path: Path, seed: int):
+    """
+    sine + pink noise speech stand-in, padded with silence, encoded with bitexact flags
+    so the same seed always produces the same bytes
+    """
+    rng = random.Random(seed)
+    # a few long clips, like nhk16/shinmeikai8 sentences among the forvo/jpod words
+    duration = rng.uniform(8, 20) if rng.random() < 0.05 else rng.uniform(0.3, 3.0)
+    lead = rng.uniform(0, 0.8)
+    trail = rng.uniform(0, 0.8)
+    frequency = rng.randint(120, 900)
+    volume = rng.uniform(0.05, 0.6)
+    encoder = dict(CODECS)[path.suffix]
+
+    cmd = [
+        ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"sine=frequency={frequency}:sample_rate=44100:duration={duration:.3f}",
+        "-f", "lavfi", "-i", f"anoisesrc=color=pink:sample_rate=44100:amplitude=0.05:seed={seed}:duration={duration:.3f}",
+        "-filter_complex",
+        f"[0:a][1:a]amix=inputs=2:normalize=0,volume={volume:.3f},adelay={int(lead * 1000)}:all=1,apad=pad_dur={trail:.3f}",
+        "-ac", "1", "-map_metadata", "-1", "-fflags", "+bitexact", "-flags:a", "+bitexact",
+        *encoder.split(), str(path),
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def generate_jmdict(path: Path, entries: int, seed: int):
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<!DOCTYPE JMdict [\n<!ENTITY uk "word usually written using kana alone">\n'
+                '<!ENTITY n "noun (common) (futsuumeishi)">\n]>\n<JMdict>\n')
+        for i in range(entries):
+            f.write(f"<entry>\n<ent_seq>{1000000 + i}</ent_seq>\n")
+            kebs = [kanji(rng, rng.randint(1, 3)) for _ in range(rng.choice([0, 1, 1, 2, 3]))]
+            for keb in kebs:
+                f.write(f"<k_ele>\n<keb>{keb}</keb>\n</k_ele>\n")
+            for _ in range(rng.choice([1, 1, 2])):
+                f.write(f"<r_ele>\n<reb>{kana(rng, rng.randint(2, 5))}</reb>\n")
+                if kebs and rng.random() < 0.1:
+                    f.write("<re_nokanji/>\n")
+                elif kebs and rng.random() < 0.2:
+                    f.write(f"<re_restr>{kebs[0]}</re_restr>\n")
+                f.write("</r_ele>\n")
+            for _ in range(rng.randint(1, 3)):
+                f.write("<sense>\n<pos>&n;</pos>\n")
+                if rng.random() < 0.3:
+                    f.write("<misc>&uk;</misc>\n")
+                f.write("<gloss>benchmark</gloss>\n</sense>\n")
+            f.write("</entry>\n")
+        f.write("</JMdict>\n")
+
+
+def generate_corpus(corpus: Path, size: int, jmdict_entries: int, ffmpeg: str):
+    """
+    builds the corpus once per size/version, and reuses it afterwards
+    """
+    stamp = corpus / "corpus.json"
+    meta = {"version": CORPUS_VERSION, "size": size, "jmdict_entries": jmdict_entries}
+    if stamp.is_file() and json.loads(stamp.read_text()) == meta:
+        return
+    print(f"-Generating corpus of {size} files in {corpus}...")
+    shutil.rmtree(corpus, ignore_errors=True)
+
+    rng = random.Random(size)
+    clips = []
+
+    # forvo-like: <user>/<word>.<ext>
+    forvo_count = size // 2
+    for i in range(forvo_count):
+        ext = rng.choice(CODECS)[0]
+        clips.append((corpus / "input/forvo_files" / f"user{i % 20}" / f"{kanji(rng, 2)}{i}{ext}", rng.randrange(2**31)))
+
+    # jpod-like: "reading - term.mp3", some terms spelled with their reading
+    jpod_count = size - forvo_count
+    jpod_files = []
+    for i in range(jpod_count // 2):
+        reading = kana(rng, rng.randint(2, 4))
+        term = reading if rng.random() < 0.2 else kanji(rng, rng.randint(1, 2))
+        path = corpus / "input/jpod_files" / f"{reading} - {term}{i}.mp3"
+        jpod_files.append(path)
+        clips.append((path, rng.randrange(2**31)))
+
+    for path in {path.parent for path, _ in clips}:
+        path.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=cpu_count()) as ex:
+        list(ex.map(lambda clip: generate_clip(ffmpeg, *clip), clips))
+
+    # jpod_alternate_files: half are byte identical duplicates of jpod_files
+    # (with the same or with a conflicting reading), the other half are new recordings
+    alternate = corpus / "input/jpod_alternate_files"
+    alternate.mkdir(parents=True, exist_ok=True)
+    new_clips = []
+    for i in range(jpod_count - len(jpod_files)):
+        if jpod_files and rng.random() < 0.5:
+            original = rng.choice(jpod_files)
+            reading, term = original.stem.split(" - ")
+            if rng.random() < 0.3:
+                reading = kana(rng, 3)
+            shutil.copyfile(original, alternate / f"{reading} - {term}.mp3")
+        else:
+            new_clips.append((alternate / f"{kana(rng, 3)} - {kanji(rng, 2)}{i}.mp3", rng.randrange(2**31)))
+    with ThreadPoolExecutor(max_workers=cpu_count()) as ex:
+        list(ex.map(lambda clip: generate_clip(ffmpeg, *clip), new_clips))
+
+    (corpus / "temp").mkdir(parents=True, exist_ok=True)
+    generate_jmdict(corpus / "temp/JMdict_e", jmdict_entries, size)
+
+    stamp.write_text(json.dumps(meta))
+
+
+def reset_workdir(corpus: Path, workdir: Path):
+    """
+    fresh work directory with the corpus inputs linked in, so every run starts cold
+    """
+    shutil.rmtree(workdir, ignore_errors=True)
+    (workdir / "temp").mkdir(parents=True)
+    os.symlink((corpus / "input").resolve(), workdir / "input")
+    os.symlink((corpus / "temp/JMdict_e").resolve(), workdir / "temp/JMdict_e")
+    for codec in ["opus", "mp3"]:
+        (workdir / "output" / codec / "user_files").mkdir(parents=True)
+
+
+def timed_run(cmd: list[str], cwd: Path) -> tuple[float, int]:
+    """
+    returns (wall seconds, peak RSS in KiB) of the command
+    """
+    start = default_timer()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = default_timer() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"benchmark command failed ({proc.returncode}): {' '.join(cmd)}")
+    return elapsed, rusage.ru_maxrss
+
+
+def count_files(path: Path) -> int:
+    return sum(1 for p in path.rglob("*") if p.is_file())
+
+
+def run_benchmarks(args, size: int) -> list[dict]:
+    corpus = Path(BENCHMARK_DIR) / f"corpus-{size}"
+    jmdict_entries = size * args.jmdict_entries_per_file
+    generate_corpus(corpus, size, jmdict_entries, args.ffmpeg)
+    workdir = Path(BENCHMARK_DIR) / f"work-{size}"
+    only = args.only or ["ffmpegmulti", "jpod_index", "parse_jmdict"]
+    results = []
+
+    def record(benchmark: str, items: int, unit: str, elapsed: float, rss: int):
+        result = {
+            "size": size,
+            "benchmark": benchmark,
+            "items": items,
+            "unit": unit,
+            "seconds": elapsed,
+            "throughput": items / elapsed if elapsed > 0 else 0.0,
+            "peak_rss_kib": rss,
+        }
+        print(f"  {benchmark:<22} size={size:<6} {elapsed:8.2f}s  {result['throughput']:10.1f} {unit}/s  {rss / 1024:7.1f}MiB")
+        results.append(result)
+
+    if "ffmpegmulti" in only:
+        reset_workdir(corpus, workdir)
+        files = count_files(corpus / "input/forvo_files")
+        cmd = [
+            sys.executable, str((SCRIPT_PATH / "ffmpegmulti.py").resolve()), "--jobs", str(args.jobs),
+            "input/forvo_files", "opus:output/opus/user_files/forvo_files", "mp3:output/mp3/user_files/forvo_files",
+        ]
+        record("ffmpegmulti_cold", files, "files", *timed_run(cmd, workdir))
+        # everything is up to date: measures discovery + the manifest check
+        record("ffmpegmulti_noop", files, "files", *timed_run(cmd, workdir))
+        # outputs removed, analysis cache kept: measures the encode path alone
+        shutil.rmtree(workdir / "output/opus/user_files/forvo_files")
+        shutil.rmtree(workdir / "output/mp3/user_files/forvo_files")
+        record("ffmpegmulti_cached", files, "files", *timed_run(cmd, workdir))
+        # same, longest files first: the difference is the tail LPT scheduling removes
+        shutil.rmtree(workdir / "output/opus/user_files/forvo_files")
+        shutil.rmtree(workdir / "output/mp3/user_files/forvo_files")
+        record("ffmpegmulti_cached_lpt", files, "files", *timed_run([*cmd, "--order", "duration"], workdir))
+        # cold again, BATCH_SIZE files per ffmpeg process
+        reset_workdir(corpus, workdir)
+        record("ffmpegmulti_cold_batch", files, "files", *timed_run([*cmd, "--batch", str(BATCH_SIZE)], workdir))
+        per_file, batched = (next(r["seconds"] for r in results if r["benchmark"] == name)
+                             for name in ["ffmpegmulti_cold", "ffmpegmulti_cold_batch"])
+        print(f"  batched vs per file ({BATCH_SIZE} files per process): {per_file / batched:.2f}x")
+
+    if "jpod_index" in only:
+        reset_workdir(corpus, workdir)
+        files = count_files(corpus / "input/jpod_files") + count_files(corpus / "input/jpod_alternate_files")
+        cmd = [sys.executable, str((SCRIPT_PATH / "jpod_index.py").resolve())]
+        record("jpod_index", files, "files", *timed_run(cmd, workdir))
+
+    if "parse_jmdict" in only:
+        reset_workdir(corpus, workdir)
+        cmd = [sys.executable, str((SCRIPT_PATH / "parse_jmdict.py").resolve())]
+        record("parse_jmdict", jmdict_entries, "entries", *timed_run(cmd, workdir))
+
+    return results
+
+
+def get_meta(args) -> dict:
+    def first_line(cmd):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, cwd=SCRIPT_PATH).stdout.splitlines()[0]
+        except (OSError, IndexError):
+            return None
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git": first_line(["git", "rev-parse", "HEAD"]),
+        "python": platform.python_version(),
+        "ffmpeg": first_line([args.ffmpeg, "-version"]),
+        "platform": platform.platform(),
+        "cpu_count": cpu_count(),
+        "jobs": args.jobs,
+    }
+
+
+def compare(results: list[dict], previous_path: str, threshold: float) -> bool:
+    """
+    prints the throughput change per benchmark, returns False if any regressed by more than threshold percent
+    """
+    with open(previous_path) as f:
+        previous = {(r["benchmark"], r["size"]): r for r in json.load(f)["results"]}
+
+    ok = True
+    print(f"-Compared to {previous_path}:")
+    for result in results:
+        old = previous.get((result["benchmark"], result["size"]))
+        if old is None or old["throughput"] == 0:
+            continue
+        change = (result["throughput"] / old["throughput"] - 1) * 100
+        regressed = change < -threshold
+        ok = ok and not regressed
+        print(f"  {result['benchmark']:<22} size={result['size']:<6} {change:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main():
+    args = get_args()
+
+    results = []
+    for size in args.sizes:
+        results.extend(run_benchmarks(args, size))
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"meta": get_meta(args), "results": results}, f, indent=2)
+    print(f"-Results written to {args.output}")
+
+    if args.compare is not None and not compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Builds the whole collection: runs the steps of the build as a DAG, independent steps at the same time.
+
+All steps share one worker budget (--jobs, default cpu_count()), handed out as the tokens of a
+make style jobserver FIFO:
+- ffmpegmulti holds one token per file being encoded (--jobserver), so when one source runs out of files,
+  its cores go to the other sources instead of idling until its last encode finishes
+- the other steps hold a fixed number of tokens (their weight) for as long as they run
+The archivers (archive.py) hold no token, they mostly wait for sections and feed the compressor.
+
+At the end, the wall time of every step and the critical path (the chain of dependencies that
+determined the total time) are printed.
+
+To start, place all <source>_files inside the input/ directory (see build-collection.sh).
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import subprocess
+from pathlib import Path
+from typing import TypedDict, Callable, Union
+from multiprocessing import cpu_count
+from timeit import default_timer
+
+SCRIPT_PATH = Path(__file__).parent
+JOBSERVER = "temp/build/jobserver.fifo"
+READY = "temp/archive_ready"
+SECTIONS = ["forvo_files", "jmdict_forms.json", "jmdict_forms.sqlite", "jpod_files", "nhk16_files", "shinmeikai8_files"]
+
+Command = Union[list[str], Callable[[], None]]
+
+
+class Stage(TypedDict):
+    name: str
+    deps: list[str]
+    # run in order, a list is a subprocess, a callable runs in a thread of build.py
+    commands: list[Command]
+    # tokens held while the stage runs (0: the stage takes its own tokens through --jobserver, or needs none)
+    weight: int
+    # archive sections that are complete once the stage is done
+    sections: list[str]
+    # archive sections the stage waits for by itself (only used to find the critical path)
+    consumes: list[str]
+
+
+class StageResult(TypedDict):
+    name: str
+    # seconds since the start of the build
+    ready: float
+    start: float
+    end: float
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=cpu_count(), help="worker budget shared by every step")
+    parser.add_argument("--no-archive", action="store_true", help="only build output/, without the final archives")
+    return parser.parse_args()
+
+
+def python(script: str, *args: str) -> list[str]:
+    return [sys.executable, str(SCRIPT_PATH / script), *args]
+
+
+def refresh_source(name: str):
+    """
+    downloads the raw JMdict file, or updates it if older than a day (stolen from yomichan_import)
+    """
+    path = f"temp/{name}"
+    if not os.path.isfile(path):
+        subprocess.run(["wget", f"ftp.edrdg.org/pub/Nihongo/{name}.gz", "-O", f"{path}.gz"], check=True)
+        with open(path, "wb") as f:
+            subprocess.run(["gunzip", "-c", f"{path}.gz"], stdout=f, check=True)
+    elif os.path.getmtime(path) < time.time() - 86400:
+        subprocess.run(["rsync", f"ftp.edrdg.org::nihongo/{name}", path], check=True)
+
+
+def write_jpod_source_meta():
+    for codec in ["opus", "mp3"]:
+        with open(f"output/{codec}/user_files/jpod_files/source_meta.json", "w") as f:
+            f.write('{\n  "type": "ajt_jp"\n}\n')
+
+
+def get_stages(jobs: int, no_archive: bool) -> list[Stage]:
+    def encode(input: str, name: str, *args: str) -> list[str]:
+        return python(
+            "ffmpegmulti.py", "--jobs", str(jobs), "--jobserver", JOBSERVER, *args, input,
+            f"opus:output/opus/user_files/{name}", f"mp3:output/mp3/user_files/{name}",
+        )
+
+    date = time.strftime("%Y-%m-%d", time.gmtime())
+    jmdict_weight = min(4, jobs)
+    jpod_index_weight = min(2, jobs)
+    stages: list[Stage] = [
+        {
+            "name": "forvo",
+            "deps": [],
+            # normalize audio, trim silence from beginning and end, and convert to both opus and mp3
+            # (broken files are skipped by ffmpegmulti, see excluded_files.json)
+            "commands": [encode("input/forvo_files", "forvo_files")],
+            "weight": 0,
+            "sections": ["forvo_files"],
+            "consumes": [],
+        },
+        {
+            "name": "jmdict_download",
+            "deps": [],
+            "commands": [lambda: refresh_source("JMdict_e")],
+            "weight": 0,
+            "sections": [],
+            "consumes": [],
+        },
+        {
+            "name": "jmdict",
+            "deps": ["jmdict_download"],
+            "commands": [python("parse_jmdict.py", "--jobs", str(jmdict_weight))],
+            "weight": jmdict_weight,
+            "sections": ["jmdict_forms.json", "jmdict_forms.sqlite"],
+            "consumes": [],
+        },
+        {
+            # index of the jpod files, without duplicates
+            "name": "jpod_index",
+            "deps": [],
+            "commands": [python("jpod_index.py", "--jobs", str(jpod_index_weight))],
+            "weight": jpod_index_weight,
+            "sections": [],
+            "consumes": [],
+        },
+        {
+            "name": "jpod",
+            "deps": ["jpod_index"],
+            "commands": [
+                encode("temp/jpod/media_manifest.json", "jpod_files", "--no-silence-remove"),
+                write_jpod_source_meta,
+                python("build_indexes.py", "--only", "jpod"),
+            ],
+            "weight": 0,
+            "sections": ["jpod_files"],
+            "consumes": [],
+        },
+        {
+            "name": "nhk16",
+            "deps": [],
+            # sentence length clips of very different lengths: longest first, so the run doesn't end on one long file
+            "commands": [
+                encode("input/nhk16_files/audio", "nhk16_files/audio", "--order", "duration"),
+                python("build_indexes.py", "--only", "nhk16"),
+            ],
+            "weight": 0,
+            "sections": ["nhk16_files"],
+            "consumes": [],
+        },
+        {
+            "name": "shinmeikai8",
+            "deps": [],
+            "commands": [
+                encode("input/shinmeikai8_files/media", "shinmeikai8_files/media", "--order", "duration"),
+                python("build_indexes.py", "--only", "shinmeikai8"),
+            ],
+            "weight": 0,
+            "sections": ["shinmeikai8_files"],
+            "consumes": [],
+        },
+    ]
+    if not no_archive:
+        for codec in ["opus", "mp3"]:
+            stages.append({
+                "name": f"archive_{codec}",
+                "deps": [],
+                "commands": [python(
+                    "archive.py", f"output/{codec}/user_files", f"local-yomichan-audio-collection-{date}-{codec}.tar.xz",
+                    "--ready-dir", READY, "--sections", *SECTIONS,
+                )],
+                "weight": 0,
+                "sections": [],
+                "consumes": SECTIONS,
+            })
+    return stages
+
+
+class TokenPool:
+    """
+    the jobserver FIFO, and build.py's own side of it
+    """
+
+    def __init__(self, path: str, tokens: int):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        os.mkfifo(path)
+        # non-blocking (only for this process, the clients open the FIFO themselves), reads wait in the event loop
+        self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        os.write(self.fd, b"+" * tokens)
+        # only one stage collects tokens at a time, two stages each holding part of what they need could wait forever
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, count: int) -> bytes:
+        tokens = b""
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.lock:
+                while len(tokens) < count:
+                    try:
+                        tokens += os.read(self.fd, count - len(tokens))
+                    except BlockingIOError:
+                        readable = loop.create_future()
+                        loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+                        try:
+                            await readable
+                        finally:
+                            loop.remove_reader(self.fd)
+        except asyncio.CancelledError:
+            self.release(tokens)
+            raise
+        return tokens
+
+    def release(self, tokens: bytes):
+        if tokens:
+            os.write(self.fd, tokens)
+
+
+def predecessors(stage: Stage, stages: list[Stage]) -> list[str]:
+    """
+    the stages this stage waits for: its dependencies, and the producers of the sections it consumes
+    """
+    producers = [other["name"] for other in stages if set(other["sections"]) & set(stage["consumes"])]
+    return stage["deps"] + producers
+
+
+def critical_path(stages: list[Stage], results: dict[str, StageResult]) -> list[tuple[str, float]]:
+    """
+    the chain of stages that determined the total time: starting from the last stage to finish,
+    repeatedly follows the predecessor that finished last (the one it waited for).
+    Returns (stage, seconds the stage added to the path), which sum up to the end of the last stage.
+    """
+    by_name = {stage["name"]: stage for stage in stages}
+    name = max(results, key=lambda n: results[n]["end"])
+    path = []
+    while True:
+        previous = predecessors(by_name[name], stages)
+        previous_end = max((results[n]["end"] for n in previous), default=0.0)
+        result = results[name]
+        path.append((name, result["end"] - max(result["start"], previous_end)))
+        if not previous:
+            break
+        name = max(previous, key=lambda n: results[n]["end"])
+    return path[::-1]
+
+
+def print_report(stages: list[Stage], results: dict[str, StageResult], elapsed: float):
+    print("\n-Stages (seconds since the start of the build):")
+    print(f"  {'stage':<18} {'ready':>8} {'start':>8} {'end':>8} {'wall':>8}")
+    for name, result in sorted(results.items(), key=lambda item: item[1]["start"]):
+        print(f"  {name:<18} {result['ready']:8.1f} {result['start']:8.1f} {result['end']:8.1f} "
+              f"{result['end'] - result['start']:8.1f}")
+    path = critical_path(stages, results)
+    print(f"-Critical path ({elapsed:.1f}s): {' -> '.join(f'{name} ({seconds:.1f}s)' for name, seconds in path)}")
+
+
+async def run_stages(stages: list[Stage], pool: TokenPool) -> dict[str, StageResult]:
+    start = default_timer()
+    results: dict[str, StageResult] = {}
+    done = {stage["name"]: asyncio.Event() for stage in stages}
+
+    async def run_stage(stage: Stage):
+        for dep in stage["deps"]:
+            await done[dep].wait()
+        ready = default_timer() - start
+        tokens = await pool.acquire(stage["weight"])
+        try:
+            stage_start = default_timer() - start
+            print(f"-[{stage['name']}] starting", flush=True)
+            for command in stage["commands"]:
+                if callable(command):
+                    await asyncio.to_thread(command)
+                    continue
+                proc = await asyncio.create_subprocess_exec(*command)
+                try:
+                    returncode = await proc.wait()
+                except asyncio.CancelledError:
+                    proc.terminate()
+                    await proc.wait()
+                    raise
+                if returncode != 0:
+                    raise RuntimeError(f"stage {stage['name']} failed ({returncode}): {' '.join(command)}")
+        finally:
+            pool.release(tokens)
+
+        for section in stage["sections"]:
+            Path(READY, section).touch()
+        results[stage["name"]] = {"name": stage["name"], "ready": ready, "start": stage_start, "end": default_timer() - start}
+        print(f"-[{stage['name']}] done in {results[stage['name']]['end'] - stage_start:.1f}s", flush=True)
+        done[stage["name"]].set()
+
+    tasks = [asyncio.create_task(run_stage(stage)) for stage in stages]
+    try:
+        # the first failure cancels (and terminates) everything else
+        for task in asyncio.as_completed(tasks):
+            await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+def main():
+    args = get_args()
+    jobs = max(1, args.jobs)
+
+    for codec in ["opus", "mp3"]:
+        os.makedirs(f"output/{codec}/user_files", exist_ok=True)
+    shutil.rmtree(READY, ignore_errors=True)
+    os.makedirs(READY)
+
+    stages = get_stages(jobs, args.no_archive)
+    pool = TokenPool(JOBSERVER, jobs)
+
+    start = default_timer()
+    results = asyncio.run(run_stages(stages, pool))
+    print_report(stages, results, default_timer() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Generates the per codec index files of every source, replacing the sed rewrites.
+
+The source indexes are parsed once. The file names inside them (whole strings, and the keys of "files",
+that end with the source extension) get the extension of each codec; nothing else is touched,
+so a "." or an extension inside a headword can't be rewritten by accident.
+
+AJT Japanese format indexes (shinmeikai8, jpod) also get an index.sqlite next to the JSON,
+so the server can do indexed lookups instead of loading and parsing the JSON at startup:
+- headwords(headword, file): headword -> files, in index order
+- files(file, kana_reading, pitch_pattern, pitch_number)
+- meta(key, value): the "meta" object of the index, values as JSON
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+from typing import Any
+
+from ffmpegmulti import CODECS
+
+OUTPUT_DIR = "output/{codec}/user_files"
+
+# name: (source index, index path under OUTPUT_DIR, extension of the source files, AJT Japanese format)
+SOURCES = {
+    "shinmeikai8": ("input/shinmeikai8_files/index.json", "shinmeikai8_files/index.json", ".aac", True),
+    "nhk16": ("input/nhk16_files/entries.json", "nhk16_files/entries.json", ".aac", False),
+    "jpod": ("temp/jpod/index.json", "jpod_files/index.json", ".mp3", True),
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", choices=list(SOURCES), nargs="+", default=None)
+    parser.add_argument("--codecs", choices=list(CODECS), nargs="+", default=["opus", "mp3"])
+    parser.add_argument("--no-sqlite", action="store_true", help="only write the JSON indexes")
+    return parser.parse_args()
+
+
+def rewrite_extensions(value: Any, old: str, new: str) -> Any:
+    """
+    returns a copy of the JSON value with every string (and key) ending in old ending in new instead
+    """
+    def rewrite(text):
+        if isinstance(text, str) and text.lower().endswith(old):
+            return text[:-len(old)] + new
+        return text
+
+    if isinstance(value, dict):
+        return {rewrite(k): rewrite_extensions(v, old, new) for k, v in value.items()}
+    if isinstance(value, list):
+        return [rewrite_extensions(v, old, new) for v in value]
+    return rewrite(value)
+
+
+def write_json(path: str, index: Any):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + ".tmp"
+    with open(partial, "w") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(partial, path)
+
+
+def write_sqlite(path: str, index: dict):
+    """
+    AJT Japanese format index -> SQLite, written under a temporary name and renamed once complete
+    """
+    partial = path + ".tmp"
+    if os.path.exists(partial):
+        os.remove(partial)
+    conn = sqlite3.connect(partial)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.execute(
+        "CREATE TABLE headwords (headword TEXT NOT NULL, position INTEGER NOT NULL, file TEXT NOT NULL, "
+        "PRIMARY KEY (headword, position)) WITHOUT ROWID"
+    )
+    conn.execute(
+        "CREATE TABLE files (file TEXT PRIMARY KEY, kana_reading TEXT, pitch_pattern TEXT, pitch_number TEXT) WITHOUT ROWID"
+    )
+    conn.executemany(
+        "INSERT INTO meta VALUES (?, ?)",
+        ((key, json.dumps(value, ensure_ascii=False)) for key, value in index.get("meta", {}).items()),
+    )
+    conn.executemany(
+        "INSERT INTO headwords VALUES (?, ?, ?)",
+        (
+            (headword, position, file)
+            for headword, files in index["headwords"].items()
+            for position, file in enumerate(files)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO files VALUES (?, ?, ?, ?)",
+        (
+            (file, info.get("kana_reading"), info.get("pitch_pattern"), info.get("pitch_number"))
+            for file, info in index["files"].items()
+        ),
+    )
+    # finds the headwords of a file
+    conn.execute("CREATE INDEX headwords_file ON headwords (file)")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(partial, path)
+
+
+def build_source(name: str, codecs: list[str], no_sqlite: bool):
+    source_index, index_path, extension, ajt_format = SOURCES[name]
+    if not os.path.isfile(source_index):
+        raise RuntimeError(f"index of {name} not found: {source_index}")
+    with open(source_index) as f:
+        index = json.load(f)
+
+    for codec in codecs:
+        rewritten = rewrite_extensions(index, extension, CODECS[codec][0])
+        path = os.path.join(OUTPUT_DIR.format(codec=codec), index_path)
+        write_json(path, rewritten)
+        if ajt_format and not no_sqlite:
+            write_sqlite(os.path.join(os.path.dirname(path), "index.sqlite"), rewritten)
+        print(f"(build_indexes) wrote {path}")
+
+
+def main():
+    args = get_args()
+    for name in args.only or SOURCES:
+        build_source(name, args.codecs, args.no_sqlite)
+
+
+if __name__ == "__main__":
+    main()
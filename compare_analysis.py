@@ -0,0 +1,93 @@
+"""
+Compares the ffmpeg and numpy analysis backends of ffmpegmulti on real files.
+
+Every file is analyzed by both backends, and the script fails if any field differs by more
+than pcm_analysis.TOLERANCE. Run it after touching either backend or the analysis config:
+
+    python compare_analysis.py input/forvo_files --limit 200
+"""
+
+import sys
+import asyncio
+import argparse
+from pathlib import Path
+
+import ffmpegmulti
+import pcm_analysis
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", type=str, nargs="+", help="audio files or directories")
+    parser.add_argument("--limit", type=int, default=None, help="only compare the first N files")
+    parser.add_argument("--no-silence-remove", default=False, action='store_true')
+    return parser.parse_args()
+
+
+def get_files(inputs: list[str], limit):
+    files = []
+    for input in inputs:
+        path = Path(input)
+        if path.is_dir():
+            files.extend(sorted(file for file in path.rglob("*") if ffmpegmulti.is_supported_audio_file(file, "compare_analysis")))
+        else:
+            files.append(path)
+    return files[:limit]
+
+
+def compare_fields(ffmpeg_analysis, numpy_analysis) -> dict[str, float]:
+    """
+    returns the absolute difference per field, inf if only one backend produced a value
+    """
+    def values(analysis):
+        result = {"start": analysis["start"], "end": analysis["end"]}
+        if analysis["loudness"] is not None:
+            result.update(analysis["loudness"])
+        return result
+
+    a = values(ffmpeg_analysis)
+    b = values(numpy_analysis)
+    diffs = {}
+    for key in pcm_analysis.TOLERANCE:
+        if a.get(key) is None and b.get(key) is None:
+            continue
+        if a.get(key) is None or b.get(key) is None:
+            diffs[key] = float("inf")
+        else:
+            diffs[key] = abs(a[key] - b[key])
+    return diffs
+
+
+def main():
+    args = get_args()
+    config = ffmpegmulti.get_config()
+
+    max_diffs = {key: 0.0 for key in pcm_analysis.TOLERANCE}
+    failures = 0
+    files = get_files(args.inputs, args.limit)
+    for file in files:
+        analyses = []
+        for backend in ffmpegmulti.ANALYSIS_BACKENDS:
+            backend_config = dict(config, analysis_backend=backend)
+            analyses.append(asyncio.run(ffmpegmulti.analyze_file(file, backend_config, False, args.no_silence_remove)))
+
+        diffs = compare_fields(*analyses)
+        exceeded = {k: v for k, v in diffs.items() if v > pcm_analysis.TOLERANCE[k]}
+        if exceeded:
+            failures += 1
+            print(f"MISMATCH {file}: {exceeded}")
+            print(f"  ffmpeg: {analyses[0]}")
+            print(f"  numpy:  {analyses[1]}")
+        for k, v in diffs.items():
+            max_diffs[k] = max(max_diffs[k], v)
+
+    print(f"-Compared {len(files)} files, {failures} outside of tolerance")
+    for key, tolerance in pcm_analysis.TOLERANCE.items():
+        print(f"  {key:<13} max diff {max_diffs[key]:.4f} (tolerance {tolerance})")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,22 @@
 from __future__ import annotations
 
 import json
+import math
+import asyncio
 import os
+import re
+import time
 import shlex
-import subprocess
+import sqlite3
+import hashlib
 import sys
 import argparse
 import traceback
-from typing import TypedDict
-from concurrent.futures import ProcessPoolExecutor
-from itertools import repeat
+import heapq
+import fnmatch
+from typing import TypedDict, Iterator
 from multiprocessing import cpu_count
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from timeit import default_timer
 from typing import Optional
 
@@ -31,7 +36,7 @@ class Config(TypedDict):
     # See: https://superuser.com/a/1727768
     af_pass: str
 
-    # "ametadata=print:file=-" outputs to stdout
+    # silence_start / silence_end are parsed from the silencedetect log output
     # d = duration of silence before it is considered as "silence"
     af_silence_detect: str
 
@@ -39,6 +44,14 @@ class Config(TypedDict):
     # Too small and some voices get cut, too big and not much silence is cut
     silence_compensate: float
 
+    # how the silences and clipping are detected (the loudness is always measured by loudnorm itself, see measure_loudness)
+    # "ffmpeg": parse the silencedetect / astats logs
+    # "numpy": decode to PCM and measure in-process (requires numpy, see pcm_analysis.py)
+    analysis_backend: str
+
+    # files with more than this fraction of their samples in runs at full scale are quarantined as clipped
+    quarantine_max_clipped: float
+
 
 def get_config() -> Config:
     DEFAULT_CONFIG = Path(__file__).parent.joinpath("default_config.json")
@@ -59,17 +72,123 @@ def get_config() -> Config:
     return config
 
 
+ANALYSIS_CACHE = "temp/ffmpegmulti/analysis_cache.sqlite"
+BUILD_MANIFEST = "temp/ffmpegmulti/manifest.sqlite"
+# bump whenever the analysis output changes, so stale cache entries are ignored
+ANALYSIS_VERSION = 9
+ANALYSIS_BACKENDS = ["ffmpeg", "numpy"]
+# sources that are never encoded, see ExclusionList
+EXCLUSIONS = Path(__file__).parent.joinpath("excluded_files.json")
+QUARANTINE_DIR = "temp/ffmpegmulti/quarantine"
+
+# codec -> (file extension, ffmpeg muxer, default quality)
+# the muxer is given explicitly because outputs are first written to a temporary name
+CODECS = {
+    "opus": (".opus", "opus", "-map_metadata -1 -application voip -b:a 32k"),
+    "mp3": (".mp3", "mp3", "-map_metadata -1 -q:a 3"),
+    "aac": (".aac", "adts", ""), # The user should probably specify this
+}
+
+
+class Target(TypedDict):
+    codec: str
+    suffix: str
+    format: str
+    quality: str
+    destination: Path
+
+
+class FileResult(TypedDict):
+    file: str
+    size: int
+    mtime_ns: int
+    digest: Optional[str]
+    ok: bool
+    # False if the file only had its timestamp changed and did not need to be re-encoded
+    encoded: bool
+    # wall time per stage ("hash", "analysis", "encode") in seconds
+    timings: dict[str, float]
+    # True if the analysis came from the analysis cache
+    cached: bool
+    duration: Optional[float]
+    output_size: int
+    # why the file was flagged as broken (see quarantine_reason), None if it wasn't
+    quarantine: Optional[str]
+
+
+class Exclusion(TypedDict):
+    # glob matched against the trailing components of the source path, e.g. "input/forvo_files/skent/解く.*"
+    pattern: str
+    reason: str
+
+
+class QuarantineEntry(TypedDict):
+    file: str
+    reason: str
+    # False if the file was skipped, True if it was flagged but encoded anyway (--no-quarantine)
+    encoded: bool
+
+
+def parse_target(value: str) -> tuple[str, str]:
+    """
+    parses CODEC:OUTPUT_DIR
+    """
+    codec, sep, output_dir = value.partition(":")
+    if not sep or codec not in CODECS or not output_dir:
+        raise argparse.ArgumentTypeError(
+            f"expected CODEC:OUTPUT_DIR with CODEC one of {', '.join(CODECS)}, got {value!r}"
+        )
+    return codec, output_dir
+
+
 def get_args():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("codec", choices=["opus", "mp3", "aac"], )
-    parser.add_argument("input_dir", type=str)
-    parser.add_argument("output_dir", type=str)
-    parser.add_argument("--quality", type=str, default=None)
+    parser.add_argument("input", type=str,
+                        help="input directory, or a manifest file of [source, output] pairs (see read_manifest)")
+    # every target is encoded from the same analysis and the same ffmpeg process
+    parser.add_argument("targets", type=parse_target, nargs="+", metavar="CODEC:OUTPUT_DIR")
+    parser.add_argument("--quality", nargs=2, action="append", default=[], metavar=("CODEC", "QUALITY"),
+                        help="overrides the default quality arguments of CODEC")
     parser.add_argument("--no-normalize", default=False, action='store_true')
     parser.add_argument("--no-silence-remove", default=False, action='store_true')
+    parser.add_argument("--analysis-backend", choices=ANALYSIS_BACKENDS, default=None,
+                        help="overrides analysis_backend of the config")
+    parser.add_argument("--no-cache", default=False, action='store_true',
+                        help="neither read nor write the analysis cache")
+    parser.add_argument("--clear-cache", default=False, action='store_true',
+                        help="empties the analysis cache before running")
+    parser.add_argument("--cache-max-entries", type=int, default=1_000_000,
+                        help="least recently used analysis results past this count are evicted after the run")
+    parser.add_argument("--rebuild", default=False, action='store_true',
+                        help="ignore the build manifest and re-encode every file")
+    parser.add_argument("--jobs", type=int, default=cpu_count(),
+                        help="number of files processed (ffmpeg processes running) at once")
+    parser.add_argument("--jobserver", type=str, default=None,
+                        help="FIFO of a shared worker budget (see build.py), one token is held per file being processed and per probe of --order duration")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="writes the per file, per stage timings to this file (JSON lines)")
+    parser.add_argument("--report-slowest", type=int, default=10,
+                        help="number of slowest files listed in the run report")
+    parser.add_argument("--order", choices=ORDERS, default="walk",
+                        help="walk: encode files as they are discovered. size/duration/history: collect the stale files first, "
+                             "then encode the most expensive first (by file size, probed duration, or --history timings)")
+    parser.add_argument("--history", type=str, default=None,
+                        help="--trace file of a previous run, used by --order history")
+    parser.add_argument("--exclusions", type=str, default=str(EXCLUSIONS),
+                        help="JSON list of {pattern, reason} of sources that are never encoded")
+    parser.add_argument("--no-quarantine", default=False, action='store_true',
+                        help="encode the files flagged by the analysis anyway (they are reported by the run that encodes them)")
+    parser.add_argument("--quarantine-report", type=str, default=None,
+                        help=f"where the skipped / flagged files are listed (default: {QUARANTINE_DIR}/<input>.json)")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="files analyzed / encoded per ffmpeg process; more than 1 saves the process startup "
+                             "on short clips, a batch that fails is run again file by file")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.clear_cache and args.no_cache:
+        parser.error("--clear-cache has no effect with --no-cache (the cache isn't opened)")
+    return args
 
 
 def os_cmd(cmd):
@@ -78,218 +197,1610 @@ def os_cmd(cmd):
     return cmd if sys.platform == "win32" else shlex.split(cmd)
 
 
-def spaghetti(output, index, str_find, silence_compensate) -> Optional[float]:
+async def run_cmd(cmd: str, capture=True) -> tuple[int, bytes, bytes]:
+    """
+    asyncio version of subprocess.run(os_cmd(cmd)), returns (returncode, stdout, stderr)
+    """
+    pipe = asyncio.subprocess.PIPE if capture else None
+    args = os_cmd(cmd)
+    if isinstance(args, str):
+        proc = await asyncio.create_subprocess_shell(args, stdout=pipe, stderr=pipe)
+    else:
+        proc = await asyncio.create_subprocess_exec(*args, stdout=pipe, stderr=pipe)
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout or b"", stderr or b""
+
+
+# silencedetect logs its events to stderr:
+# [Parsed_silencedetect_6 @ 0x5581b1a7b940] silence_start: 0
+# [Parsed_silencedetect_6 @ 0x5581b1a7b940] silence_end: 0.541813 | silence_duration: 0.541813
+rx_SILENCE = re.compile(r'silence_(start|end): (\S+)')
+# loudnorm (print_format=json) logs its first pass measurements at the end, under a line naming the filter:
+# [Parsed_loudnorm_0 @ 0x5581b1a7c2c0]
+# {
+# 	"input_i" : "-26.49",
+# 	...
+# 	"target_offset" : "1.52"
+# }
+rx_LOUDNORM_JSON = re.compile(r'^(\[[^\]\n]*\])[ \t]*\n(\{[^{}]*\})', re.MULTILINE)
+# astats logs its statistics at the end, per channel and then "Overall":
+# [Parsed_astats_11 @ 0x5581b1a7d0c0] Overall
+# [Parsed_astats_11 @ 0x5581b1a7d0c0] Peak level dB: -0.000265
+# [Parsed_astats_11 @ 0x5581b1a7d0c0] Flat factor: 15.563025
+# [Parsed_astats_11 @ 0x5581b1a7d0c0] Peak count: 2210.000000
+# [Parsed_astats_11 @ 0x5581b1a7d0c0] Number of samples: 66150
+rx_ASTATS_OVERALL = re.compile(r'\] Overall$', re.MULTILINE)
+rx_ASTATS_STAT = re.compile(r'\] (Peak level dB|Flat factor|Peak count|Number of samples): (\S+)')
+# ffmpeg couldn't open the input, as logged by ffmpeg <= 6 and by ffmpeg 7:
+# input/forvo_files/skent/解く.mp3: Invalid data found when processing input
+# [in#0 @ 0x55d4c0c1c2c0] Error opening input: Invalid data found when processing input
+rx_INPUT_UNREADABLE = re.compile(r'^.*: (?:Invalid data found when processing input|End of file)$', re.MULTILINE)
+# the input opened, but has no audio stream for [0:a]:
+# Stream specifier ':a' in filtergraph description [0:a]asplit=2[a0][a1];... matches no streams.
+rx_NO_AUDIO_STREAM = re.compile(r"Stream specifier ':a' .* matches no streams")
+# a packet ffmpeg failed to decode (and skipped) in input #k, as logged by ffmpeg <= 6 and by ffmpeg 7:
+# Error while decoding stream #0:0: Invalid data found when processing input
+# [aist#0:0/mp3 @ 0x55d4c0c1c2c0] [dec:mp3float @ 0x55d4c0c1d000] Decoding error: Invalid data found when processing input
+rx_DECODE_ERROR = re.compile(r'Error while decoding stream #(\d+):\d+|^\[aist#(\d+):\d+/.*Decoding error', re.MULTILINE)
+#   Stream #0:0: Audio: mp3, 44100 Hz, mono, fltp, 64 kb/s
+rx_INPUT_SAMPLE_RATE = re.compile(r'Stream #\d+:\d+.*?: Audio: .*?, (\d+) Hz')
+# the silencedetect filter of af_silence_detect / the loudnorm filter of af_norm, without an instance name yet
+rx_SILENCEDETECT_FILTER = re.compile(r'(?<![\w@])silencedetect(?=[=,;\[]|$)')
+rx_LOUDNORM_FILTER = re.compile(r'(?<![\w@])loudnorm(?=[=,;\[]|$)')
+#   Duration: 00:00:01.54, start: 0.025057, bitrate: 65 kb/s
+rx_INPUT_DURATION = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+# ffmpeg prints a header per opened input, followed by its duration:
+# Input #3, mp3, from 'input/forvo_files/skent/解く.mp3':
+rx_INPUT_HEADER = re.compile(r'^Input #(\d+), ', re.MULTILINE)
+# log prefix of a filter named by build_batch_analysis_cmd, e.g. [astats@fmm3 @ 0x5581b1a7c2c0]
+rx_BATCH_INSTANCE = re.compile(r'^\[[^\]\s]*?(?<![0-9A-Za-z])fmm(\d+)(?!\d)[^\]]*\]')
+
+# slack when comparing the silences to the duration of the file
+SILENCE_SLACK = 0.1
+# a sample clips if it is at full scale once converted to 16 bit (within 1 LSB)
+CLIP_LEVEL_DB = -0.01
+# samples at full scale only count as clipping in runs at least this long, a single peak sample is fine
+CLIP_MIN_RUN = 3
+# with decode errors, a file is broken if less than this fraction of its duration (as in its header) could be decoded
+DECODE_MIN_RATIO = 0.9
+# BS.1770's absolute gate, audio below it is silence for loudnorm
+ABSOLUTE_GATE = -70.0
+# loudnorm measures 400ms blocks, it reports -inf for a shorter region however loud it is
+LOUDNORM_BLOCK = 0.4
+# the loudnorm first pass values passed to the second pass, and the range loudnorm accepts for each
+# see: https://github.com/slhck/ffmpeg-normalize/blob/78a1363e96d6e592f6b85b89de46648335e0df34/ffmpeg_normalize/_streams.py#LL372C35-L372C41
+LOUDNORM_RANGES = {
+    "input_i": (-99.0, 0.0),
+    "input_lra": (0.0, 99.0),
+    "input_tp": (-99.0, 99.0),
+    "input_thresh": (-99.0, 0.0),
+    "target_offset": (-99.0, 99.0),
+}
+
+
+class LoudnessStats(TypedDict):
+    input_i: float
+    input_lra: float
+    input_tp: float
+    input_thresh: float
+    # target_i - the loudness of the first pass's output, the offset of the second pass
+    target_offset: float
+
+
+class Analysis(TypedDict):
+    # -ss / -to values for the encode; end is None if the file doesn't end in silence
+    start: float
+    end: Optional[float]
+    # length of the decoded audio in seconds (the duration in the header if unknown), None if both are unknown
+    duration: Optional[float]
+    # None if normalization is disabled or the trimmed region is too short to measure (it is then encoded without normalization)
+    loudness: Optional[LoudnessStats]
+    # not a single sample could be decoded
+    empty: bool
+    # no non-silent region (silencedetect never ends its first silence, or everything is below the absolute gate)
+    silent: bool
+    # fraction of the samples in runs at full scale (see parse_clipping), None if unknown
+    clipped: Optional[float]
+
+
+def name_filter(chain: str, rx_filter: re.Pattern, name: str, instance: str) -> str:
+    """
+    names the one filter of chain matched by rx_filter, e.g. silencedetect -> silencedetect@fmm3
     """
-    spaghetti
+    named, count = rx_filter.subn(f"{name}{instance}", chain)
+    if count != 1:
+        raise RuntimeError(f"{chain} must contain exactly one {name} to be batched")
+    return named
 
-    Attemps to parse the output of ffmpeg to get the fp value after str_find.
-    TODO: use regex instead?
+
+def loudnorm_branch(config: Config, instance: str = "") -> str:
+    """
+    loudnorm's first pass: it measures the audio and logs the values its second pass takes (see parse_loudnorm_stats)
     """
-    offset_start = len(str_find) + 1 # str_find=
-    if output[index+offset_start:index+offset_start+2] == "0\n":
+    af_norm = name_filter(config["af_norm"], rx_LOUDNORM_FILTER, "loudnorm", instance) if instance else config["af_norm"]
+    return f"{af_norm}:print_format=json"
+
+
+def analysis_branches(config: Config, detect_silence: bool, measure_loudness: bool, instance: str = "") -> list[str]:
+    """
+    the filter chains of the analysis: silencedetect on the af_pass cleaned audio, loudnorm on the untouched audio.
+    instance (e.g. "@fmm3") names the measuring filters, which then log under that name.
+
+    loudnorm can only measure the whole input here, so it is only part of the analysis when the silences aren't trimmed
+    (see analyze_file); otherwise it runs once the trimmed region is known (see measure_loudness).
+    The astats branch converts to 16 bit, which saturates whatever the decoder put past full scale,
+    so clipped passages end up as runs of samples at full scale (see parse_clipping).
+    """
+    branches = []
+    if detect_silence:
+        silence_detect = config["af_silence_detect"]
+        if instance:
+            silence_detect = name_filter(silence_detect, rx_SILENCEDETECT_FILTER, "silencedetect", instance)
+        branches.append(f'{config["af_pass"]},{silence_detect}')
+    if measure_loudness:
+        branches.append(loudnorm_branch(config, instance))
+    branches.append(f"aformat=sample_fmts=s16,astats{instance}")
+    return branches
+
+
+def build_analysis_cmd(file, config: Config, detect_silence: bool, measure_loudness: bool) -> str:
+    """
+    Builds a single ffmpeg invocation that decodes the file once and splits it into
+    the silencedetect, loudnorm and astats branches (see analysis_branches).
+    """
+    branches = analysis_branches(config, detect_silence, measure_loudness)
+    labels = [f"[a{i}]" for i in range(len(branches))]
+    graph = f"[0:a]asplit={len(branches)}{''.join(labels)};" + ";".join(
+        f"{label}{branch}[o{i}]" for i, (label, branch) in enumerate(zip(labels, branches))
+    )
+    maps = " ".join(f"-map [o{i}]" for i in range(len(branches)))
+
+    arg_input = f"-i \"{file}\""
+    return f'{config["ffmpeg"]} -hide_banner -nostats -loglevel info {arg_input} -filter_complex "{graph}" {maps} -f null -'
+
+
+def build_batch_analysis_cmd(files: list, config: Config, detect_silence: bool, measure_loudness: bool) -> str:
+    """
+    build_analysis_cmd for several files in one ffmpeg process.
+    Every input gets a filtergraph of its own (one -filter_complex each): commands sent by asendcmd (see af_pass)
+    go to the first matching filter of the graph, which in a shared graph would be the one of the first input.
+    The measuring filters of input k are named @fmm<k>, so split_batch_output can tell their log lines apart.
+    """
+    arg_inputs = []
+    arg_graphs = []
+    maps = []
+    for k, file in enumerate(files):
+        branches = analysis_branches(config, detect_silence, measure_loudness, f"@fmm{k}")
+        labels = [f"[a{k}_{i}]" for i in range(len(branches))]
+        graph = f"[{k}:a]asplit={len(branches)}{''.join(labels)};" + ";".join(
+            f"{label}{branch}[o{k}_{i}]" for i, (label, branch) in enumerate(zip(labels, branches))
+        )
+        arg_inputs.append(f"-i \"{file}\"")
+        arg_graphs.append(f'-filter_complex "{graph}"')
+        maps.extend(f"-map [o{k}_{i}]" for i in range(len(branches)))
+
+    return (f'{config["ffmpeg"]} -hide_banner -nostats -loglevel info {" ".join(arg_inputs)} '
+            f'{" ".join(arg_graphs)} {" ".join(maps)} -f null -')
+
+
+def build_loudnorm_cmd(file, config: Config, analysis: Analysis) -> str:
+    """
+    loudnorm's first pass over the trimmed region, with the same seek as the encode (see build_encode_cmd)
+    """
+    return (f'{config["ffmpeg"]} -hide_banner -nostats -loglevel info {seek_args(analysis)} -i "{file}" '
+            f'-filter_complex "[0:a]{loudnorm_branch(config)}" -f null -')
+
+
+def build_batch_loudnorm_cmd(items: list[tuple[Path, Analysis]], config: Config) -> str:
+    """
+    build_loudnorm_cmd for several (file, analysis) in one ffmpeg process, the loudnorm of input k is named @fmm<k>
+    """
+    arg_inputs = []
+    arg_graphs = []
+    maps = []
+    for k, (file, analysis) in enumerate(items):
+        arg_inputs.append(f'{seek_args(analysis)} -i "{file}"')
+        arg_graphs.append(f'-filter_complex "[{k}:a]{loudnorm_branch(config, f"@fmm{k}")}[o{k}]"')
+        maps.append(f"-map [o{k}]")
+    return (f'{config["ffmpeg"]} -hide_banner -nostats -loglevel info {" ".join(arg_inputs)} '
+            f'{" ".join(arg_graphs)} {" ".join(maps)} -f null -')
+
+
+def split_batch_output(output: str, count: int) -> list[str]:
+    """
+    splits the log of a batched analysis into the log each input would have had on its own:
+    its "Input #k" header (with the duration), and the lines of its @fmm<k> filters.
+    Unprefixed indented lines continue the block above them.
+    """
+    outputs: list[list[str]] = [[] for _ in range(count)]
+    owner = None
+    for line in output.splitlines():
+        header = rx_INPUT_HEADER.match(line)
+        instance = rx_BATCH_INSTANCE.match(line)
+        if header is not None:
+            owner = int(header.group(1))
+        elif instance is not None:
+            owner = int(instance.group(1))
+        elif line and not line[0].isspace():
+            owner = None
+        if owner is not None and owner < count:
+            outputs[owner].append(line)
+    return ["\n".join(lines) for lines in outputs]
+
+
+def parse_silences(output: str) -> list[tuple[float, Optional[float]]]:
+    """
+    returns the (silence_start, silence_end) pairs logged by silencedetect.
+    silence_end is None if the file ends in silence.
+    """
+    silences: list[tuple[float, Optional[float]]] = []
+    for kind, value in rx_SILENCE.findall(output):
+        if kind == "start":
+            silences.append((float(value), None))
+        elif silences and silences[-1][1] is None:
+            silences[-1] = (silences[-1][0], float(value))
+    return silences
+
+
+def parse_duration(output: str) -> Optional[float]:
+    match = rx_INPUT_DURATION.search(output)
+    if match is None:
         return None
-    # If there is a \n but it's not followed by a zero, change offset_end to be smaller accordingly.
-    elif "\n" in output[index+offset_start:index+offset_start+4]:
-        offset_end = offset_start + len(output[index+offset_start:index+offset_start+4].split("\n")[0])
-    else:
-        offset_end = offset_start + 4
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_loudnorm_stats(output: str) -> dict[Optional[int], LoudnessStats]:
+    """
+    the first pass measurements of every loudnorm of the log, by batch instance (None for an unnamed loudnorm).
+    Invalid values (-inf for silence...) are clamped to the ranges loudnorm accepts, see LOUDNORM_RANGES.
+    """
+    stats: dict[Optional[int], LoudnessStats] = {}
+    for match in rx_LOUDNORM_JSON.finditer(output):
+        values = json.loads(match.group(2))
+        if not all(key in values for key in LOUDNORM_RANGES):
+            continue
+        instance = rx_BATCH_INSTANCE.match(match.group(1))
+        loudness = {}
+        for key, (low, high) in LOUDNORM_RANGES.items():
+            value = float(values[key])
+            loudness[key] = low if math.isnan(value) else min(high, max(low, value))
+        stats[None if instance is None else int(instance.group(1))] = loudness
+    return stats
+
+
+def parse_decoded_duration(output: str) -> Optional[float]:
+    """
+    seconds of audio actually decoded: the samples counted by astats, at the sample rate of the input.
+    astats logs nothing when it got no samples at all, which makes 0 once the input's audio stream was opened.
+    """
+    overall = list(rx_ASTATS_OVERALL.finditer(output))
+    sample_rate = rx_INPUT_SAMPLE_RATE.search(output)
+    if sample_rate is None:
+        return None
+    if not overall:
+        return 0.0
+    samples = dict(rx_ASTATS_STAT.findall(output[overall[-1].end():])).get("Number of samples")
+    if samples is None:
+        return None
+    return float(samples) / int(sample_rate.group(1))
+
+
+def count_decode_errors(output: str) -> dict[int, int]:
+    """
+    number of packets that failed to decode, per input index
+    """
+    errors: dict[int, int] = {}
+    for match in rx_DECODE_ERROR.finditer(output):
+        index = int(match.group(1) or match.group(2))
+        errors[index] = errors.get(index, 0) + 1
+    return errors
+
+
+def check_decode(file, errors: int, decoded: Optional[float], duration: Optional[float]):
+    """
+    ffmpeg skips the packets it fails to decode. A few of them are common in mp3s (a junk frame, a truncated last frame)
+    and the file still encodes fine, so they are only a warning. The file is broken (DecodeError) if the errors cost
+    a real part of the audio: nothing decoded, or less than DECODE_MIN_RATIO of the duration of its header.
+    Without the decoded duration, there is nothing to compare to and the errors are only a warning.
+    """
+    if errors == 0:
+        return
+    if decoded is not None and (decoded <= 0 or (duration is not None and decoded < DECODE_MIN_RATIO * duration)):
+        of_duration = "" if duration is None else f" of {duration:.2f}s"
+        raise DecodeError(f"{errors} packets failed to decode, only {decoded:.2f}s{of_duration} decoded")
+    print(f"WARNING ON FILE: {file}: {errors} packets failed to decode and were skipped")
+
 
-    sil_end = None
+def parse_clipping(output: str) -> Optional[float]:
+    """
+    fraction of the samples in runs at full scale, from the astats "Overall" statistics:
+    Peak count is the number of samples at the minimum or maximum level, and
+    Flat factor is 20 * log10(sum(run^2) / sum(run)) over the runs of those samples, i.e. their (length weighted) mean run length.
+    A signal that only touches full scale with isolated samples is not clipped.
+    None if the statistics are missing.
+    """
+    overall = list(rx_ASTATS_OVERALL.finditer(output))
+    if not overall:
+        return None
+    stats = dict(rx_ASTATS_STAT.findall(output[overall[-1].end():]))
+    try:
+        peak_level = float(stats["Peak level dB"])
+        flat_factor = float(stats["Flat factor"])
+        peak_count = float(stats["Peak count"])
+        samples = float(stats["Number of samples"])
+    except (KeyError, ValueError):
+        return None
+    if samples <= 0 or peak_level < CLIP_LEVEL_DB:
+        return 0.0
+    mean_run = 10 ** (flat_factor / 20) if math.isfinite(flat_factor) else 1.0
+    if mean_run < CLIP_MIN_RUN:
+        return 0.0
+    return min(1.0, peak_count / samples)
+
+
+def crop_bounds(silences: list[tuple[float, Optional[float]]], silence_compensate: float, duration: Optional[float]) -> tuple[float, Optional[float]]:
+    """
+    returns (STARTING_SILENCE_END, ENDING_SILENCE_START), both padded by silence_compensate.
+    ENDING_SILENCE_START is None if the file doesn't end in silence.
+    duration is the length of the decoded audio, None if unknown.
+    """
+    start = 0.0
+    if silences and silences[0][1] is not None:
+        start = max(0.0, silences[0][1] - silence_compensate)  # Clamp value
+
+    end = None
+    # the output can end with a silence_start -> silence_end pair,
+    # meaning the file does NOT end in silence! Unless that silence_end is the end of the audio:
+    # newer ffmpeg builds (7.0 at least) also close the silence the stream ends in
+    if silences and silences[-1][0] > start:
+        last_start, last_end = silences[-1]
+        if last_end is None or (duration is not None and last_end >= duration - SILENCE_SLACK):
+            end = last_start + silence_compensate
+
+    return start, end
+
+
+async def loudnorm_first_pass(file, config: Config, analysis: Analysis) -> Optional[LoudnessStats]:
+    """
+    loudnorm's own first pass over the trimmed region (see build_loudnorm_cmd), the values its second pass takes.
+    None if loudnorm measured nothing.
+    """
+    returncode, _, stderr = await run_cmd(build_loudnorm_cmd(file, config, analysis))
+    output = stderr.decode("utf8", "replace")
+    if returncode != 0:
+        raise RuntimeError(f"loudness measurement failed ({returncode}):\n{output[-1000:]}")
+    return parse_loudnorm_stats(output).get(None)
+
+
+async def analyze_file_pcm(file, config: Config, detect_silence: bool) -> tuple[list[tuple[float, Optional[float]]], float, float]:
+    """
+    numpy backend: a single decode to raw PCM, measured by pcm_analysis
+    """
     try:
-        # Gets the value after silence_end= in stdout
-        # Example output in stdout: lavfi.silence_end=0.541813
-        sil_end = float(output[index+offset_start:index+offset_end]) - silence_compensate
-    except ValueError as err:  # wtf
-        print(f"--------\n\n<><>[Kuru Kuru Kuru Kuru]<><>\n{err}")
-        print(f"Attempted to find {str_find}\n-OUTPUT-{output}")
-        print(f"\n-silence_index+offset-\n{output[index+offset_start:]}\n--------")
+        import pcm_analysis
+    except ImportError as e:
+        raise RuntimeError("the numpy analysis backend requires numpy to be installed") from e
+
+    cmd = pcm_analysis.build_decode_cmd(file, config)
+    returncode, stdout, stderr = await run_cmd(cmd)
+    if returncode != 0:
+        output = stderr.decode("utf8", "replace")
+        reason = broken_input_reason(returncode, output)
+        if reason is not None:
+            raise DecodeError(reason)
+        raise RuntimeError(f"decode failed ({returncode}):\n{output[-1000:]}")
+    # numpy releases the GIL for the heavy parts, so this doesn't stall the other files
+    silences, decoded, clipped = await asyncio.to_thread(pcm_analysis.analyze_pcm, stdout, config, detect_silence)
+    output = stderr.decode("utf8", "replace")
+    check_decode(file, sum(count_decode_errors(output).values()), decoded, parse_duration(output))
+    return silences, decoded, clipped
+
+
+async def analyze_file(file, config: Config, no_normalize, no_silence_remove) -> Analysis:
+    """
+    runs the silence and clipping analysis for a file, then loudnorm's first pass over the region left after trimming
+    """
+    detect_silence = not no_silence_remove
+    measure_loudness = not no_normalize
+    if not detect_silence and not measure_loudness:
+        return {"start": 0.0, "end": None, "duration": None, "loudness": None, "empty": False, "silent": False, "clipped": None}
+
+    # without trimming, loudnorm measures the whole file, so it is part of the analysis decode
+    single_pass = measure_loudness and not detect_silence and config["analysis_backend"] != "numpy"
+    if config["analysis_backend"] == "numpy":
+        silences, duration, clipped = await analyze_file_pcm(file, config, detect_silence)
+        decoded = duration
+    else:
+        cmd = build_analysis_cmd(file, config, detect_silence, single_pass)
+        returncode, _, stderr = await run_cmd(cmd)
+        output = stderr.decode("utf8", "replace")
+        if returncode != 0:
+            reason = broken_input_reason(returncode, output)
+            if reason is not None:
+                raise DecodeError(reason)
+            raise RuntimeError(f"analysis failed ({returncode}):\n{output[-1000:]}")
+        silences, duration, clipped = parse_analysis_output(output, detect_silence)
+        decoded = parse_decoded_duration(output)
+        check_decode(file, sum(count_decode_errors(output).values()), decoded, duration)
+
+    analysis = finish_analysis(silences, duration, decoded, clipped, config, detect_silence)
+    if measure_loudness and not analysis["empty"]:
+        loudness = parse_loudnorm_stats(output).get(None) if single_pass else await loudnorm_first_pass(file, config, analysis)
+        add_loudness(analysis, loudness)
+    return analysis
+
+
+async def analyze_batch(files: list, config: Config, no_normalize, no_silence_remove) -> list[Analysis]:
+    """
+    analyze_file for several files with a single ffmpeg process (see build_batch_analysis_cmd),
+    and a second one for loudnorm's first pass over their trimmed regions (see build_batch_loudnorm_cmd).
+    Raises if a process failed, the caller retries the files one by one.
+    """
+    detect_silence = not no_silence_remove
+    measure_loudness = not no_normalize
+    if config["analysis_backend"] == "numpy" or (not detect_silence and not measure_loudness):
+        # the numpy backend reads the PCM from stdout, which can't be shared between inputs
+        return [await analyze_file(file, config, no_normalize, no_silence_remove) for file in files]
+
+    single_pass = measure_loudness and not detect_silence
+    cmd = build_batch_analysis_cmd(files, config, detect_silence, single_pass)
+    returncode, _, stderr = await run_cmd(cmd)
+    output = stderr.decode("utf8", "replace")
+    if returncode != 0:
+        raise RuntimeError(f"batch analysis failed ({returncode}):\n{output[-1000:]}")
+
+    # the decode errors name their input (which isn't the name of a filter, so they stay out of split_batch_output)
+    decode_errors = count_decode_errors(output)
+    analyses = []
+    for k, (file, file_output) in enumerate(zip(files, split_batch_output(output, len(files)))):
+        silences, duration, clipped = parse_analysis_output(file_output, detect_silence)
+        decoded = parse_decoded_duration(file_output)
+        # a broken file fails the batch, and is quarantined when the batch is run again file by file
+        check_decode(file, decode_errors.get(k, 0), decoded, duration)
+        analyses.append(finish_analysis(silences, duration, decoded, clipped, config, detect_silence))
+    if not measure_loudness:
+        return analyses
+
+    measured = [k for k, analysis in enumerate(analyses) if not analysis["empty"]]
+    loudness: dict[Optional[int], LoudnessStats] = {}
+    if single_pass:
+        loudness = parse_loudnorm_stats(output)
+    elif measured:
+        returncode, _, stderr = await run_cmd(build_batch_loudnorm_cmd([(files[k], analyses[k]) for k in measured], config))
+        output = stderr.decode("utf8", "replace")
+        if returncode != 0:
+            raise RuntimeError(f"batch loudness measurement failed ({returncode}):\n{output[-1000:]}")
+        loudness = {measured[i]: stats for i, stats in parse_loudnorm_stats(output).items() if i is not None and i < len(measured)}
+    for k in measured:
+        if k not in loudness:
+            raise RuntimeError(f"no loudness measured for {files[k]} in the batch log")
+        add_loudness(analyses[k], loudness[k])
+    return analyses
+
+
+def parse_analysis_output(output: str, detect_silence: bool) -> tuple[list[tuple[float, Optional[float]]], Optional[float], Optional[float]]:
+    silences = parse_silences(output) if detect_silence else []
+    return silences, parse_duration(output), parse_clipping(output)
+
+
+def finish_analysis(silences: list[tuple[float, Optional[float]]], duration: Optional[float], decoded: Optional[float], clipped: Optional[float],
+                    config: Config, detect_silence: bool) -> Analysis:
+    """
+    trims the silences; the loudness of what is left is measured afterwards (see add_loudness).
+    duration is the one of the header, decoded the length of the audio actually decoded (both None if unknown).
+    Only the decoded audio tells whether the file is empty, a header can be missing its duration or be wrong.
+    """
+    length = decoded if decoded is not None else duration
+    start, end = 0.0, None
+    if detect_silence:
+        start, end = crop_bounds(silences, config["silence_compensate"], length)
+
+    empty = decoded is not None and decoded <= 0
+    silent = (
+        detect_silence and bool(silences) and silences[0][0] <= SILENCE_SLACK
+        and (silences[0][1] is None or (length is not None and silences[0][1] >= length - SILENCE_SLACK))
+    )
+
+    return {"start": start, "end": end, "duration": length, "loudness": None, "empty": empty, "silent": silent, "clipped": clipped}
+
+
+def region_length(analysis: Analysis) -> Optional[float]:
+    """
+    seconds left after trimming (what loudnorm and the encode get), None if the length of the file is unknown
+    """
+    if analysis["duration"] is None:
+        return None
+    end = analysis["duration"] if analysis["end"] is None else min(analysis["end"], analysis["duration"])
+    return max(0.0, end - analysis["start"])
+
+
+def add_loudness(analysis: Analysis, loudness: Optional[LoudnessStats]):
+    """
+    a region that loudnorm measures below the absolute gate has no non-silent audio either,
+    unless it is shorter than LOUDNORM_BLOCK: loudnorm had nothing to measure, the file is fine
+    but can't be normalized (loudness None), so it is encoded as is
+    """
+    if loudness is not None and loudness["input_i"] <= ABSOLUTE_GATE:
+        length = region_length(analysis)
+        if length is not None and length < LOUDNORM_BLOCK:
+            loudness = None
+        else:
+            analysis["silent"] = True
+    analysis["loudness"] = loudness
+
+
+class DecodeError(RuntimeError):
+    """
+    the file (or part of it) can't be decoded, it is quarantined instead of being encoded
+    """
+
+
+def broken_input_reason(returncode: int, output: str) -> Optional[str]:
+    """
+    why a failed analysis means the input itself is broken: ffmpeg couldn't open it, or it has no audio.
+    None for every other failure (a bad filter in the config, ffmpeg killed by a signal, out of memory...),
+    which must fail the file like any other error instead of quarantining it.
+    """
+    # negative: killed by a signal
+    if returncode <= 0:
+        return None
+    if rx_INPUT_HEADER.search(output) is None:
+        unreadable = rx_INPUT_UNREADABLE.search(output)
+        if unreadable is not None:
+            return f"unreadable input: {unreadable.group(0).strip()}"
+    elif rx_NO_AUDIO_STREAM.search(output) is not None:
+        return "no audio stream"
+    return None
+
+
+def quarantine_reason(analysis: Analysis, config: Config) -> Optional[str]:
+    """
+    why the analysis says the file is broken, None if it looks fine
+    """
+    if analysis["empty"]:
+        return "no audio decoded"
+    if analysis["silent"]:
+        return "no non-silent region"
+    if analysis["clipped"] is not None and analysis["clipped"] > config["quarantine_max_clipped"]:
+        return f"clipping ({analysis['clipped']:.1%} of the samples in runs at full scale)"
+    return None
+
+
+class ExclusionList:
+    """
+    The declarative list of broken sources (see excluded_files.json), shared with jpod_index.py.
+
+    A pattern is written relative to the directory the build runs in (input/forvo_files/...),
+    and is matched against as many trailing components of the absolute path of a file as it has itself,
+    so it matches no matter the working directory, or whether the input was given as a relative or absolute path.
+    """
+
+    def __init__(self, path: str):
+        self.exclusions: list[Exclusion] = []
+        if os.path.isfile(path):
+            with open(path, encoding="utf8") as f:
+                self.exclusions = json.load(f)
+        self.parts = [tuple(PurePosixPath(e["pattern"]).parts) for e in self.exclusions]
+        self.matches = [0] * len(self.exclusions)
+        # the parent directories of the files checked, to tell which unmatched patterns concern the run
+        self.dirs: set[tuple[str, ...]] = set()
+
+    def reason(self, file) -> Optional[str]:
+        """
+        why the file is excluded, None if it isn't
+        """
+        absolute = Path(os.path.abspath(file))
+        parts = absolute.parts
+        self.dirs.add(parts[:-1])
+        for i, (exclusion, pattern_parts) in enumerate(zip(self.exclusions, self.parts)):
+            if PurePosixPath(exclusion["pattern"]).is_absolute():
+                path = absolute.as_posix()
+            else:
+                path = "/".join(parts[-len(pattern_parts):])
+            if fnmatch.fnmatchcase(path, exclusion["pattern"]):
+                self.matches[i] += 1
+                return exclusion["reason"]
+        return None
+
+    def unmatched(self) -> list[Exclusion]:
+        """
+        the patterns that matched no file although the run went through their directory
+        (or that have a glob in their directory, which can't be told apart), most likely a typo or a renamed file
+        """
+        unmatched = []
+        for exclusion, pattern_parts, matches in zip(self.exclusions, self.parts, self.matches):
+            if matches:
+                continue
+            directory = pattern_parts[:-1]
+            globbed = any(c in part for part in directory for c in "*?[")
+            if globbed or any(d[-len(directory):] == directory for d in self.dirs if directory):
+                unmatched.append(exclusion)
+        return unmatched
+
+
+def file_digest(file) -> str:
+    with open(file, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").hexdigest()
+
+
+def analysis_settings(config: Config, no_normalize, no_silence_remove) -> str:
+    """
+    hash of everything besides the file content that affects analyze_file
+    """
+    settings = {
+        "version": ANALYSIS_VERSION,
+        "af_pass": config["af_pass"],
+        "af_silence_detect": config["af_silence_detect"],
+        "af_norm": config["af_norm"],
+        "silence_compensate": config["silence_compensate"],
+        "analysis_backend": config["analysis_backend"],
+        "no_normalize": no_normalize,
+        "no_silence_remove": no_silence_remove,
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
 
-    return sil_end
 
+class AnalysisCache:
+    """
+    Content-addressed cache of analyze_file results.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis ("
+            "digest TEXT NOT NULL, settings TEXT NOT NULL, analysis TEXT NOT NULL, last_used INTEGER NOT NULL, "
+            "PRIMARY KEY (digest, settings))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS analysis_last_used ON analysis (last_used)")
+        self.conn.commit()
+
+    def get(self, digest: str, settings: str) -> Optional[Analysis]:
+        row = self.conn.execute(
+            "SELECT analysis FROM analysis WHERE digest = ? AND settings = ?", (digest, settings)
+        ).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute(
+                "UPDATE analysis SET last_used = ? WHERE digest = ? AND settings = ?", (int(time.time()), digest, settings)
+            )
+        return json.loads(row[0])
+
+    def put(self, digest: str, settings: str, analysis: Analysis):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?)",
+                (digest, settings, json.dumps(analysis), int(time.time())),
+            )
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM analysis")
 
-def ffmpeg_crop(file, config: Config):
+    def evict(self, max_entries: int) -> int:
+        """
+        removes the least recently used entries past max_entries, returns the number of evicted entries
+        """
+        with self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM analysis WHERE rowid IN "
+                "(SELECT rowid FROM analysis ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (max_entries,),
+            )
+        return cursor.rowcount
+
+
+async def cached_analyze_file(file, digest: str, config: Config, no_normalize, no_silence_remove, cache: Optional[AnalysisCache]) -> tuple[Analysis, bool]:
+    """
+    returns (analysis, whether it came from the cache)
+    """
+    if cache is None or (no_normalize and no_silence_remove):
+        return await analyze_file(file, config, no_normalize, no_silence_remove), False
+
+    settings = analysis_settings(config, no_normalize, no_silence_remove)
+    analysis = cache.get(digest, settings)
+    if analysis is not None:
+        return analysis, True
+    analysis = await analyze_file(file, config, no_normalize, no_silence_remove)
+    cache.put(digest, settings, analysis)
+    return analysis, False
+
+
+def seek_args(analysis: Analysis) -> str:
     """
     returns -ss STARTING_SILENCE_END -to ENDING_SILENCE_START
     or -ss STARTING_SILENCE_END (if ENDING_SILENCE_START doesn't exist)
     """
-    arg_input = f"-i \"{file}\""
-    arg_output = "-f null -"
-    arg_filters = f'-af "{config["af_pass"]},{config["af_silence_detect"]}"'
-    cmd = f'{config["ffmpeg"]} {arg_input} {arg_filters} {arg_output}'
+    seek = f"-ss {analysis['start']}"
+    if analysis["end"] is not None:
+        seek += f" -to {analysis['end']}"
+    return seek
 
-    output: str = subprocess.run(
-        os_cmd(cmd), text=True, capture_output=True, encoding="utf8"
-    ).stdout
 
-    # spaghetti below
-    SIL_END_FIND = "silence_end"
-    SIL_START_FIND = "silence_start"
+def measured_args(loudness: LoudnessStats) -> str:
+    return (f':measured_I={loudness["input_i"]}:measured_LRA={loudness["input_lra"]}:measured_tp={loudness["input_tp"]}'
+            f':measured_thresh={loudness["input_thresh"]}:offset={loudness["target_offset"]}')
+
+
+def encode_settings(config: Config, target: Target, no_normalize, no_silence_remove) -> str:
+    """
+    hash of everything besides the file content that affects a target's output
+    """
+    settings = {
+        "analysis": analysis_settings(config, no_normalize, no_silence_remove),
+        "globals": config["globals"],
+        "codec": target["codec"],
+        "quality": target["quality"],
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def output_path(relative: Path, target: Target) -> Path:
+    """
+    relative is the path of the output under each target's destination, without regard to its suffix
+    """
+    return target["destination"].joinpath(relative).with_suffix(target["suffix"])
 
-    # WARNING: .index() can raise ValueError's, so we must wrap them...
-    sil_end = 0
-    try:
-        sil_index = output.index(SIL_END_FIND)
-        sil_end = spaghetti(output, sil_index, SIL_END_FIND, config["silence_compensate"])
-    except ValueError:
-        pass
-    sil_end_val = 0 if sil_end is None else max(0, sil_end)  # Clamp value
-    sil_end_str = f"-ss {sil_end_val}"
-
-    # more spaghetti below
-    # we look for the last instance of silence_start
-    sil_start_str = ""
-    try:
-        # if the output ends with silence_start, then it ends in silence
-        # however, the output can end with a silence_start -> silence_end pair,
-        # meaning the file does NOT end in silence!
-        sil_index_end1 = output.rfind("silence_start")
-        sil_index_end2 = output.rfind("silence_end")
 
-        sil_end_1 = spaghetti(output, sil_index_end1, SIL_START_FIND, 0)
-        sil_end_2 = spaghetti(output, sil_index_end2, SIL_END_FIND, 0)
+def partial_path(output: Path) -> Path:
+    return output.with_name(output.name + ".tmp")
 
-        if sil_end_1 is not None and sil_end_2 is not None and sil_end_1 > sil_end_2:
-            sil_start = spaghetti(output, sil_index_end1, SIL_START_FIND, -config["silence_compensate"])
-            sil_start_str = "" if sil_start is None else f"-to {sil_start}"
-    except ValueError:
-        pass
 
-    return sil_end_str + " " + sil_start_str
+MANIFEST_LOCK_RETRIES = 5
 
-def get_file_volume(file, srcpath, config: Config, seek):
+
+class BuildManifest:
     """
-    analyze the volume of a file via loudnorm
-    for perl example see https://github.com/FFmpeg/FFmpeg/blob/master/tools/loudnorm.rb
+    Records which source (and which settings) every output was built from,
+    so reruns only encode new or changed files.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "output TEXT PRIMARY KEY, source TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "digest TEXT NOT NULL, settings TEXT NOT NULL, last_run INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS quarantine (source TEXT PRIMARY KEY, reason TEXT NOT NULL, run_id INTEGER NOT NULL)")
+        self.conn.commit()
+
+    def stale_targets(self, file: Path, stat: os.stat_result, relative: Path, targets: list[Target], settings: list[str]) -> tuple[list[Target], Optional[str]]:
+        """
+        returns the targets that have to be rebuilt, and the recorded digest of the source
+        if the only difference is the source's size/mtime (the worker compares it to the actual content)
+        """
+        stale = []
+        digests = set()
+        for target, target_settings in zip(targets, settings):
+            output = output_path(relative, target)
+            row = self.conn.execute(
+                "SELECT source, size, mtime_ns, digest, settings FROM outputs WHERE output = ?", (str(output),)
+            ).fetchone()
+            if row is None or row[0] != str(file) or row[4] != target_settings or not output.is_file():
+                stale.append(target)
+                digests.add(None)
+            elif (row[1], row[2]) != (stat.st_size, stat.st_mtime_ns):
+                stale.append(target)
+                digests.add(row[3])
+
+        skip_digest = next(iter(digests)) if len(digests) == 1 else None
+        return stale, skip_digest
+
+    def write(self, sql: str, rows: list[tuple]):
+        """
+        runs sql for every row in one transaction. Another build writing to the same manifest
+        can hold the lock past the connection's timeout, which would abort this whole build
+        from handle_result, so "database is locked" is retried a few times before giving up.
+        """
+        for attempt in range(MANIFEST_LOCK_RETRIES):
+            try:
+                with self.conn:
+                    self.conn.executemany(sql, rows)
+                return
+            except sqlite3.OperationalError as e:
+                if "database is locked" not in str(e) or attempt == MANIFEST_LOCK_RETRIES - 1:
+                    raise
+                print(f"-manifest is locked, retrying ({attempt + 1}/{MANIFEST_LOCK_RETRIES - 1})")
+                time.sleep(2 ** attempt)
+
+    def touch(self, outputs: list[str], run_id: int):
+        """
+        marks the outputs of every discovered source as still wanted
+        """
+        self.write("UPDATE outputs SET last_run = ? WHERE output = ?", [(run_id, o) for o in outputs])
+
+    def record(self, result: FileResult, outputs: list[str], settings: list[str], run_id: int):
+        self.write(
+            "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (output, result["file"], result["size"], result["mtime_ns"], result["digest"], target_settings, run_id)
+                for output, target_settings in zip(outputs, settings)
+            ],
+        )
+
+    def is_quarantined(self, file: Path) -> bool:
+        return self.conn.execute("SELECT 1 FROM quarantine WHERE source = ?", (str(file),)).fetchone() is not None
+
+    def quarantine(self, source: str, reason: str, run_id: int):
+        """
+        marks a source flagged by the analysis and not encoded. Its outputs are kept by this run,
+        the next run prunes them unless the file passes the analysis by then (see main)
+        """
+        self.write("INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?)", [(source, reason, run_id)])
+
+    def unquarantine(self, source: str):
+        self.write("DELETE FROM quarantine WHERE source = ?", [(source,)])
+
+    def prune(self, destination: Path, run_id: int) -> int:
+        """
+        deletes the outputs under destination whose source was not seen in this run
+        """
+        prefix = os.path.join(str(destination), "")
+        rows = self.conn.execute(
+            "SELECT output FROM outputs WHERE substr(output, 1, ?) = ? AND last_run != ?",
+            (len(prefix), prefix, run_id),
+        ).fetchall()
+        for (output,) in rows:
+            Path(output).unlink(missing_ok=True)
+        self.write("DELETE FROM outputs WHERE output = ?", rows)
+        return len(rows)
+
+
+def build_encode_cmd(file, targets: list[Target], outputs: list[Path], config: Config, analysis: Analysis, no_normalize, no_silence_remove) -> str:
+    """
+    one ffmpeg process decodes (and normalizes) the input once and writes every target
     """
     arg_input = f"-i \"{file}\""
-    arg_output = '-f null -'
-    arg_filters = f'-af "{config["af_norm"]}:print_format=json"'
-    cmd = f'{config["ffmpeg"]} -hide_banner {seek} {arg_input} {arg_filters} {arg_output}'
-
-    output: str = subprocess.run(
-        os_cmd(cmd), text=True, capture_output=True, encoding="utf8"
-    ).stderr
-
-    # remove the crap from the beginning of the output
-    output_json = "{" + output[output.find('"input_i"'):]
-    ln_stats = json.loads(output_json)
-
-    # fix invalid values
-    # copied from
-    # https://github.com/slhck/ffmpeg-normalize/blob/78a1363e96d6e592f6b85b89de46648335e0df34/ffmpeg_normalize/_streams.py#LL372C35-L372C41
-
-    for key in [
-        "input_i",
-        "input_tp",
-        "input_lra",
-        "input_thresh",
-        "output_i",
-        "output_tp",
-        "output_lra",
-        "output_thresh",
-        "target_offset",
-    ]:
-        # handle infinite values
-        if float(ln_stats[key]) == -float("inf"):
-            ln_stats[key] = -99
-        elif float(ln_stats[key]) == float("inf"):
-            ln_stats[key] = 0
+    seek = "" if no_silence_remove else seek_args(analysis)
+
+    arg_filters = ""
+    arg_outputs = []
+    # a region too short to measure is not normalized (see add_loudness)
+    if no_normalize or analysis["loudness"] is None:
+        sources = ["0:a"] * len(targets)
+    else:
+        sources = [f"[e{i}]" for i in range(len(targets))]
+        arg_filters = f'-filter_complex "[0:a]{config["af_norm"]}{measured_args(analysis["loudness"])},asplit={len(targets)}{"".join(sources)}"'
+
+    for source, target, output in zip(sources, targets, outputs):
+        arg_outputs.append(f'-map {source} {target["quality"]} -f {target["format"]} "{output}"')
+
+    return f'{config["ffmpeg"]} {config["globals"]} {seek} {arg_input} {arg_filters} {" ".join(arg_outputs)}'
+
+
+def build_batch_encode_cmd(items: list[tuple[Path, list[Target], list[Path], Analysis]], config: Config, no_normalize, no_silence_remove) -> str:
+    """
+    build_encode_cmd for several (file, targets, outputs, analysis) in one ffmpeg process,
+    every input with its own seek, filtergraph and outputs
+    """
+    arg_inputs = []
+    arg_filters = []
+    arg_outputs = []
+    for k, (file, targets, outputs, analysis) in enumerate(items):
+        seek = "" if no_silence_remove else seek_args(analysis)
+        arg_inputs.append(f'{seek} -i "{file}"')
+        if no_normalize or analysis["loudness"] is None:
+            sources = [f"{k}:a"] * len(targets)
         else:
-            # convert to floats
-            ln_stats[key] = float(ln_stats[key])
+            sources = [f"[e{k}_{i}]" for i in range(len(targets))]
+            arg_filters.append(f'-filter_complex "[{k}:a]{config["af_norm"]}{measured_args(analysis["loudness"])},asplit={len(targets)}{"".join(sources)}"')
 
-    return f':measured_I={ln_stats["input_i"]}:measured_LRA={ln_stats["input_lra"]}:measured_tp={ln_stats["input_tp"]}:measured_thresh={ln_stats["input_thresh"]}:offset={ln_stats["target_offset"]}'
+        for source, target, output in zip(sources, targets, outputs):
+            arg_outputs.append(f'-map {source} {target["quality"]} -f {target["format"]} "{output}"')
 
+    return f'{config["ffmpeg"]} {config["globals"]} {" ".join(arg_inputs)} {" ".join(arg_filters)} {" ".join(arg_outputs)}'
 
 
-def ffmpeg_run(file, codec, destination, quality, srcpath, config: Config, no_normalize, no_silence_remove):
+async def ffmpeg_run(file, targets: list[Target], relative: Path, config: Config, no_normalize, no_silence_remove, cache: Optional[AnalysisCache], skip_digest: Optional[str], quarantine: bool = True) -> FileResult:
+    """
+    analysis -> encode chain of a single file.
+    A file the analysis flags as broken is not encoded (unless quarantine is False), see FileResult["quarantine"].
+    """
+    result = new_file_result(file)
+    timings = result["timings"]
+    partials = []
     try:
-        arg_input = f"-i \"{file}\""
-        arg_output = f"\"{destination.joinpath(file.relative_to(srcpath)).with_suffix(codec)}\""
-        #arg_filters = "" if no_normalize else f'-af "{config["af_norm"]}"'
-        #print(f"The input arg is {arg_input} and the output args to to ffmpeg is {arg_output}")
-        seek = "" if no_silence_remove else ffmpeg_crop(file, config)
-        arg_filters = ""
-        if not no_normalize:
-            measured = get_file_volume(file, srcpath, config, seek)
-            arg_filters = f'-af "{config["af_norm"]}{measured}"'
-
-        cmd = f'{config["ffmpeg"]} {config["globals"]} {seek} {arg_input} {arg_filters} {quality} {arg_output}'
-
-        subprocess.run(os_cmd(cmd))
+        stage_start = default_timer()
+        digest = await asyncio.to_thread(file_digest, file)
+        timings["hash"] = default_timer() - stage_start
+        result["digest"] = digest
+        if digest == skip_digest:
+            # touched but unchanged, the existing outputs are still valid
+            result["ok"] = True
+            return result
+
+        stage_start = default_timer()
+        try:
+            analysis, result["cached"] = await cached_analyze_file(file, digest, config, no_normalize, no_silence_remove, cache)
+        except DecodeError as e:
+            result["quarantine"] = f"decode error: {e}"
+            return result
+        finally:
+            timings["analysis"] = default_timer() - stage_start
+        result["duration"] = analysis["duration"]
+        result["quarantine"] = quarantine_reason(analysis, config)
+        if result["quarantine"] is not None and quarantine:
+            return result
+
+        # outputs are written under a temporary name and renamed once complete,
+        # so an interrupted encode never leaves a truncated file behind that looks finished
+        outputs = [output_path(relative, target) for target in targets]
+        partials = [partial_path(output) for output in outputs]
+        cmd = build_encode_cmd(file, targets, partials, config, analysis, no_normalize, no_silence_remove)
+
+        stage_start = default_timer()
+        returncode, _, _ = await run_cmd(cmd, capture=False)
+        timings["encode"] = default_timer() - stage_start
+        if returncode != 0:
+            raise RuntimeError(f"encode failed ({returncode})")
+        for partial, output in zip(partials, outputs):
+            os.replace(partial, output)
+            result["output_size"] += output.stat().st_size
+
+        result["ok"] = True
+        result["encoded"] = True
     except Exception as e:
         # effectively skip error if exists
         print("ERROR ON FILE:", file)
         traceback.print_exception(e)
+        for partial in partials:
+            partial.unlink(missing_ok=True)
+
+    return result
+
+
+def new_file_result(file) -> FileResult:
+    try:
+        stat = file.stat()
+        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+    except FileNotFoundError:
+        # removed since the walk, the run then fails on it (when hashing) like on any other error
+        size, mtime_ns = 0, 0
+    return {
+        "file": str(file),
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "digest": None,
+        "ok": False,
+        "encoded": False,
+        "timings": {},
+        "cached": False,
+        "duration": None,
+        "output_size": 0,
+        "quarantine": None,
+    }
+
+
+async def ffmpeg_run_batch(batch: list[tuple[Path, Path, list[Target], Optional[str]]], config: Config, no_normalize, no_silence_remove,
+                           cache: Optional[AnalysisCache], quarantine: bool = True) -> tuple[list[FileResult], bool]:
+    """
+    ffmpeg_run for a batch of (file, relative, targets, skip_digest), with one analysis and one encode process
+    for the whole batch, so the process startup and filtergraph setup are paid once per batch instead of once per file.
+    The time of a batched stage is split evenly between the files of the batch.
+
+    If any part of the batch fails, the batch is run again file by file (with the analyses cached so far),
+    so a bad file only fails itself. Returns (results, whether the batch was run again file by file).
+    """
+    results = [new_file_result(file) for file, *_ in batch]
+    partials: list[Path] = []
+    try:
+        async def hash_file(file, result: FileResult):
+            stage_start = default_timer()
+            result["digest"] = await asyncio.to_thread(file_digest, file)
+            result["timings"]["hash"] = default_timer() - stage_start
+
+        await asyncio.gather(*(hash_file(file, result) for (file, *_), result in zip(batch, results)))
+
+        # (file, relative, targets, result) of the files that have to be encoded
+        todo = []
+        for (file, relative, targets, skip_digest), result in zip(batch, results):
+            if result["digest"] == skip_digest:
+                # touched but unchanged, the existing outputs are still valid
+                result["ok"] = True
+            else:
+                todo.append((file, relative, targets, result))
+        if not todo:
+            return results, False
+
+        use_cache = cache is not None and not (no_normalize and no_silence_remove)
+        settings = analysis_settings(config, no_normalize, no_silence_remove)
+        analyses: dict[int, Analysis] = {}
+        for i, (_, _, _, result) in enumerate(todo):
+            analysis = cache.get(result["digest"], settings) if use_cache else None
+            if analysis is not None:
+                analyses[i] = analysis
+                result["cached"] = True
+                result["timings"]["analysis"] = 0.0
+        missing = [i for i in range(len(todo)) if i not in analyses]
+        if missing:
+            stage_start = default_timer()
+            analyzed = await analyze_batch([todo[i][0] for i in missing], config, no_normalize, no_silence_remove)
+            share = (default_timer() - stage_start) / len(missing)
+            for i, analysis in zip(missing, analyzed):
+                analyses[i] = analysis
+                todo[i][3]["timings"]["analysis"] = share
+                if use_cache:
+                    cache.put(todo[i][3]["digest"], settings, analysis)
+
+        flagged = set()
+        for i, (_, _, _, result) in enumerate(todo):
+            result["duration"] = analyses[i]["duration"]
+            result["quarantine"] = quarantine_reason(analyses[i], config)
+            if result["quarantine"] is not None and quarantine:
+                flagged.add(i)
+        kept = [i for i in range(len(todo)) if i not in flagged]
+        todo = [todo[i] for i in kept]
+        analyses = {new: analyses[old] for new, old in enumerate(kept)}
+        if not todo:
+            return results, False
+
+        items = []
+        outputs = []
+        for i, (file, relative, targets, result) in enumerate(todo):
+            file_outputs = [output_path(relative, target) for target in targets]
+            file_partials = [partial_path(output) for output in file_outputs]
+            outputs.append(file_outputs)
+            partials.extend(file_partials)
+            items.append((file, targets, file_partials, analyses[i]))
+        cmd = build_batch_encode_cmd(items, config, no_normalize, no_silence_remove)
+
+        stage_start = default_timer()
+        returncode, _, _ = await run_cmd(cmd, capture=False)
+        share = (default_timer() - stage_start) / len(todo)
+        if returncode != 0:
+            raise RuntimeError(f"batch encode failed ({returncode})")
+        for (_, _, targets, result), file_outputs, (_, _, file_partials, _) in zip(todo, outputs, items):
+            for partial, output in zip(file_partials, file_outputs):
+                os.replace(partial, output)
+                result["output_size"] += output.stat().st_size
+            result["timings"]["encode"] = share
+            result["ok"] = True
+            result["encoded"] = True
+    except Exception as e:
+        print(f"BATCH FAILED, running its {len(batch)} files one by one: {str(e).splitlines()[0] if str(e) else type(e).__name__}")
+        for partial in partials:
+            partial.unlink(missing_ok=True)
+        results = []
+        for file, relative, targets, skip_digest in batch:
+            results.append(await ffmpeg_run(file, targets, relative, config, no_normalize, no_silence_remove, cache, skip_digest, quarantine))
+        return results, True
+
+    return results, False
+
+
+class JobServer:
+    """
+    Client of a make style jobserver: a FIFO holding one byte per worker of a budget shared between processes.
+    A token is read before a file is processed and written back once it is done, so cores that one run
+    leaves idle (e.g. during its tail) are picked up by the other runs.
+    """
+
+    def __init__(self, path: str):
+        # O_RDWR so the open doesn't block until there is a writer
+        self.fd = os.open(path, os.O_RDWR)
+
+    async def acquire(self) -> bytes:
+        return await asyncio.to_thread(os.read, self.fd, 1)
+
+    def release(self, token: bytes):
+        os.write(self.fd, token)
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+    nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+class RunReport:
+    """
+    Collects the per file timings of a run, optionally writes them as a JSON-lines trace,
+    and prints the throughput / per stage latency summary at the end.
+    """
+
+    STAGES = ["hash", "analysis", "encode"]
+
+    def __init__(self, trace_path: Optional[str], slowest: int):
+        self.trace = open(trace_path, "w", encoding="utf8") if trace_path is not None else None
+        self.slowest = slowest
+        self.stage_times: dict[str, list[float]] = {stage: [] for stage in self.STAGES}
+        # min heap of (total time, file), keeps the slowest N
+        self.slowest_files: list[tuple[float, str]] = []
+        self.files = 0
+        self.cached = 0
+        self.audio_seconds = 0.0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.batches = 0
+        self.batches_retried = 0
+
+    def add(self, result: FileResult):
+        self.files += 1
+        self.cached += result["cached"]
+        self.audio_seconds += result["duration"] or 0.0
+        self.input_bytes += result["size"]
+        self.output_bytes += result["output_size"]
+        for stage, seconds in result["timings"].items():
+            self.stage_times[stage].append(seconds)
+
+        total = sum(result["timings"].values())
+        if len(self.slowest_files) < self.slowest:
+            heapq.heappush(self.slowest_files, (total, result["file"]))
+        elif self.slowest_files and total > self.slowest_files[0][0]:
+            heapq.heapreplace(self.slowest_files, (total, result["file"]))
+
+        if self.trace is not None:
+            record = {
+                "file": result["file"],
+                "ok": result["ok"],
+                "cached": result["cached"],
+                "size": result["size"],
+                "duration": result["duration"],
+                "output_size": result["output_size"],
+                "quarantine": result["quarantine"],
+                "timings": result["timings"],
+            }
+            self.trace.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def add_batch(self, retried: bool):
+        self.batches += 1
+        self.batches_retried += retried
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+
+    def print_summary(self, elapsed: float):
+        if self.files == 0:
+            return
+        print("-RUN REPORT:")
+        print(f"  {self.files} files ({self.cached} cached analyses), {self.audio_seconds:.1f}s of audio, "
+              f"{self.input_bytes / 2**20:.1f}MiB -> {self.output_bytes / 2**20:.1f}MiB")
+        print(f"  throughput: {self.files / elapsed:.2f} files/s, {self.audio_seconds / elapsed:.2f} audio-s/s")
+        if self.batches:
+            print(f"  {self.batches} batches ({self.files / self.batches:.1f} files each), "
+                  f"{self.batches_retried} run again file by file")
+        for stage, times in self.stage_times.items():
+            if not times:
+                continue
+            times.sort()
+            print(f"  {stage:<8} n={len(times):<7} total={sum(times):9.1f}s  "
+                  f"p50={percentile(times, 50):.3f}s  p95={percentile(times, 95):.3f}s  p99={percentile(times, 99):.3f}s")
+        if self.slowest_files:
+            print(f"  slowest {len(self.slowest_files)} files:")
+            for total, file in sorted(self.slowest_files, reverse=True):
+                print(f"    {total:8.3f}s  {file}")
 
 
-def is_supported_audio_file(path):
+    def print_schedule(self, order: str, jobs: int, makespan: float, tail: float, job_seconds: list[float], order_seconds: float):
+        """
+        makespan: from the first file started to the last one done. No schedule can beat the lower bound,
+        the work spread evenly over the workers (or the longest file, if that is longer).
+        The tail is the time after the last file was started, when workers run out of files and go idle.
+        """
+        work = sum(job_seconds)
+        lower_bound = max(work / max(1, jobs), max(job_seconds))
+        print(f"-SCHEDULE (--order {order}):")
+        print(f"  makespan {makespan:.1f}s, lower bound {lower_bound:.1f}s ({makespan / lower_bound if lower_bound else 1.0:.2f}x), "
+              f"worker utilization {work / (max(1, jobs) * makespan) * 100 if makespan else 100.0:.0f}%")
+        print(f"  tail {tail:.1f}s ({tail / makespan * 100 if makespan else 0.0:.0f}% of the makespan), "
+              f"ordering took {order_seconds:.1f}s")
+
+
+# audio container formats supposedly supported by browsers (excluding webm since it's typically for videos)
+AUDIO_EXTENSIONS = ['.mp3', '.m4a', '.aac', '.ogg', '.oga', '.opus', '.flac', '.wav']
+
+
+def is_supported_audio_file(path, caller: str):
     """
-    copy-paste from local-audio-yomichan and jpod_index.py
+    copy-paste from local-audio-yomichan and jpod_index.py.
+    caller is the name of the script the skipped files are reported for
     """
     if not isinstance(path, Path):
         path = Path(path)
     if not path.is_file():
         return False
-    # audio container formats supposedly supported by browsers (excluding webm since it's typically for videos)
-    if path.suffix.lower() not in ['.mp3', '.m4a', '.aac', '.ogg', '.oga', '.opus', '.flac', '.wav']:
-        print(f"(ffmpegmulti) skipping non-audio file: {path}")
+    if path.suffix.lower() not in AUDIO_EXTENSIONS:
+        print(f"({caller}) skipping non-audio file: {path}")
         return False
 
     return True
 
 
+def iter_audio_files(root: Path, caller: str) -> Iterator[Path]:
+    """
+    streaming version of filter(is_supported_audio_file, root.rglob("*")), see is_supported_audio_file for caller.
+    os.scandir gets the file type from the directory listing, so no file is stat'ed here.
+    Entries are sorted per directory so the processing order is reproducible.
+    """
+    with os.scandir(root) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from iter_audio_files(Path(entry.path), caller)
+        elif entry.is_file():
+            if os.path.splitext(entry.name)[1].lower() not in AUDIO_EXTENSIONS:
+                print(f"({caller}) skipping non-audio file: {entry.path}")
+                continue
+            yield Path(entry.path)
+
+
+def read_manifest(path: Path) -> Iterator[tuple[Path, Path]]:
+    """
+    a manifest is a JSON list of [source path, output path relative to each destination] pairs,
+    e.g. written by jpod_index.py. Sources are encoded in place, without being copied to a temporary tree first.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    for source, relative in entries:
+        yield Path(source), Path(relative)
+
+
+def iter_inputs(input_path: Path) -> Iterator[tuple[Path, Path]]:
+    """
+    yields (source, output path relative to each destination) for a directory or a manifest
+    """
+    if input_path.is_file():
+        yield from read_manifest(input_path)
+    else:
+        for file in iter_audio_files(input_path, "ffmpegmulti"):
+            yield file, file.relative_to(input_path)
+
+
+ORDERS = ["walk", "size", "duration", "history"]
+# inputs per ffmpeg process when probing durations
+PROBE_BATCH = 64
+
+
+def parse_input_durations(output: str) -> list[Optional[float]]:
+    """
+    durations of the inputs ffmpeg opened, in order. Stops at the first input it couldn't open.
+    """
+    headers = list(rx_INPUT_HEADER.finditer(output))
+    durations = []
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(output)
+        durations.append(parse_duration(output[header.end():end]))
+    return durations
+
+
+async def probe_durations(files: list[Path], config: Config, jobs: int, jobserver: Optional[JobServer]) -> dict[Path, float]:
+    """
+    durations of files from their container headers, PROBE_BATCH files per ffmpeg process (-i a -i b ...,
+    without any output, so ffmpeg exits right after printing the input headers).
+    An input that can't be opened ends its batch early; it is left out and the rest of the batch is probed again.
+    Every probe process holds a slot and a jobserver token, like an encode.
+    """
+    slots = asyncio.Semaphore(max(1, jobs))
+    durations: dict[Path, float] = {}
+
+    async def probe(batch: list[Path]):
+        while batch:
+            arg_inputs = " ".join(f'-i "{file}"' for file in batch)
+            async with slots:
+                token = None if jobserver is None else await jobserver.acquire()
+                try:
+                    _, _, stderr = await run_cmd(f'{config["ffmpeg"]} -hide_banner -nostdin {arg_inputs}')
+                finally:
+                    if token is not None:
+                        jobserver.release(token)
+            probed = parse_input_durations(stderr.decode(errors="replace"))
+            for file, duration in zip(batch, probed):
+                if duration is not None:
+                    durations[file] = duration
+            batch = batch[len(probed) + 1:]
+
+    await asyncio.gather(*(probe(files[i:i + PROBE_BATCH]) for i in range(0, len(files), PROBE_BATCH)))
+    return durations
+
+
+def load_history(path: str) -> dict[str, tuple[int, float]]:
+    """
+    file -> (size, seconds spent on it) from a --trace file. Files that weren't encoded (up to date
+    or failed) are left out, their timings say nothing about the cost of an encode.
+    """
+    history = {}
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["ok"] and "encode" in record["timings"]:
+                history[record["file"]] = (record["size"], sum(record["timings"].values()))
+    return history
+
+
+def estimate_costs(sizes: list[int], known: list[Optional[float]]) -> list[float]:
+    """
+    fills the unknown costs from the file size, scaled by the cost per byte of the known ones
+    """
+    known_size = sum(size for size, cost in zip(sizes, known) if cost is not None)
+    known_cost = sum(cost for cost in known if cost is not None)
+    per_byte = known_cost / known_size if known_size else 1.0
+    return [cost if cost is not None else size * per_byte for size, cost in zip(sizes, known)]
+
+
+def order_jobs(pending: list[tuple[Path, Path, list[Target], Optional[str]]], order: str, config: Config, jobs: int,
+               jobserver: Optional[JobServer], history_path: Optional[str]) -> list[tuple[Path, Path, list[Target], Optional[str]]]:
+    """
+    longest processing time first: with the expensive files started early, the run ends on the short ones,
+    instead of one worker finishing a long file while the others are idle
+    """
+    sizes = [file.stat().st_size for file, *_ in pending]
+    if order == "size":
+        costs = [float(size) for size in sizes]
+    elif order == "duration":
+        durations = asyncio.run(probe_durations([file for file, *_ in pending], config, jobs, jobserver))
+        costs = estimate_costs(sizes, [durations.get(file) for file, *_ in pending])
+    else:
+        if history_path is None:
+            raise RuntimeError("--order history requires --history")
+        history = load_history(history_path)
+        known = []
+        for (file, *_), size in zip(pending, sizes):
+            previous = history.get(str(file))
+            # a file that changed since has no meaningful history
+            known.append(previous[1] if previous is not None and previous[0] == size else None)
+        costs = estimate_costs(sizes, known)
+    # stable, so files of equal cost stay in walk order
+    ranked = sorted(range(len(pending)), key=lambda i: costs[i], reverse=True)
+    return [pending[i] for i in ranked]
+
+
+def quarantine_report_path(input_path: Path) -> Path:
+    slug = re.sub(r'[^\w.-]+', "_", input_path.as_posix()).strip("_")
+    return Path(QUARANTINE_DIR, f"{slug}.json")
+
+
+def write_quarantine_report(path: Path, entries: list[QuarantineEntry]):
+    """
+    always written (even empty), so the report of a previous run doesn't linger once its files are fixed
+    """
+    os.makedirs(path.parent, exist_ok=True)
+    tmp = partial_path(path)
+    with open(tmp, "w", encoding="utf8") as f:
+        json.dump(sorted(entries, key=lambda e: e["file"]), f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
 def main():
     config = get_config()
     args = get_args()
 
-    if args.codec == "opus":
-        codec = ".opus"
-        quality = "-map_metadata -1 -application voip -b:a 32k"
-    elif args.codec == "mp3":
-        codec = ".mp3"
-        quality = "-map_metadata -1 -q:a 3"
-    elif args.codec == "aac":
-        codec = ".aac"
-        quality = "" # The user should probably specify this
-    else:
-        raise RuntimeError("this should not be reached")
+    if args.analysis_backend is not None:
+        config["analysis_backend"] = args.analysis_backend
+    if config["analysis_backend"] not in ANALYSIS_BACKENDS:
+        raise RuntimeError(f"unknown analysis_backend: {config['analysis_backend']}")
 
+    qualities = {codec: quality for codec, (_, _, quality) in CODECS.items()}
     # overrides default quality with user specified quality, if exists
-    if args.quality is not None:
-        quality = args.quality
-
-    forvo = Path(args.input_dir)
-    destination = Path(args.output_dir)
-    if not forvo.is_dir():
-        raise RuntimeError(f"input dir is not valid: {forvo}")
-
-    # copy directory tree from source if the dest dir doesn't exist
-    if not destination.is_dir():
-        print("-Making destination directories...")
-        for dirpath, dirnames, _ in os.walk(forvo):
-            for dirname in dirnames:
-                src_dir = os.path.join(dirpath, dirname)
-                dest_dir = os.path.join(destination, os.path.relpath(src_dir, forvo))
-                os.makedirs(dest_dir, exist_ok=True)
+    for codec, quality in args.quality:
+        if codec not in CODECS:
+            raise RuntimeError(f"unknown codec for --quality: {codec}")
+        qualities[codec] = quality
+
+    targets: list[Target] = [
+        {
+            "codec": codec,
+            "suffix": CODECS[codec][0],
+            "format": CODECS[codec][1],
+            "quality": qualities[codec],
+            "destination": Path(output_dir),
+        }
+        for codec, output_dir in args.targets
+    ]
+
+    input_path = Path(args.input)
+    if not input_path.exists():
+        raise RuntimeError(f"input is not a valid directory or manifest: {input_path}")
+
+    exclusions = ExclusionList(args.exclusions)
+    quarantined: list[QuarantineEntry] = []
+    quarantine_path = Path(args.quarantine_report) if args.quarantine_report is not None else quarantine_report_path(input_path)
+
+    cache = None if args.no_cache else AnalysisCache(ANALYSIS_CACHE)
+    if cache is not None and args.clear_cache:
+        print("-Clearing analysis cache...")
+        cache.clear()
 
     print("-Running; let it cook...")
 
     start = default_timer()
 
-    files = [file for file in filter(is_supported_audio_file, forvo.rglob("*"))]
-    files_total = len(files)
+    manifest = BuildManifest(BUILD_MANIFEST)
+    run_id = time.time_ns()
+    settings = [encode_settings(config, target, args.no_normalize, args.no_silence_remove) for target in targets]
+
+    # discovery state, updated by iter_jobs() as the walk progresses
+    walk = {"done": False, "jobs": 0, "up_to_date": 0, "excluded": 0, "missing": 0}
+
+    def iter_jobs() -> Iterator[tuple[Path, Path, list[Target], Optional[str]]]:
+        """
+        walks the input and yields the files (and targets) that have to be encoded
+        """
+        created_dirs = set()
+        touched = []
+        for file, relative in iter_inputs(input_path):
+            # never touched, so the outputs of a previous run are pruned at the end
+            reason = exclusions.reason(file)
+            if reason is not None:
+                walk["excluded"] += 1
+                quarantined.append({"file": str(file), "reason": f"excluded: {reason}", "encoded": False})
+                continue
+
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                # e.g. listed by a manifest, but removed since: the file fails (its outputs are kept), the walk goes on
+                print(f"\nERROR ON FILE: {file}: source not found")
+                walk["missing"] += 1
+                touched.extend(str(output_path(relative, target)) for target in targets)
+                continue
+
+            # mirrors the source directory tree as it is discovered
+            if relative.parent not in created_dirs:
+                created_dirs.add(relative.parent)
+                for target in targets:
+                    os.makedirs(output_path(relative, target).parent, exist_ok=True)
+
+            if manifest.is_quarantined(file):
+                # flagged by a previous run: analyzed again, and not touched,
+                # so its outputs are pruned at the end unless it passes (and is recorded) this time
+                stale, skip_digest = targets, None
+            else:
+                touched.extend(str(output_path(relative, target)) for target in targets)
+                if len(touched) >= 1000:
+                    manifest.touch(touched, run_id)
+                    touched = []
+
+                if args.rebuild:
+                    stale, skip_digest = targets, None
+                else:
+                    stale, skip_digest = manifest.stale_targets(file, stat, relative, targets, settings)
+            if stale:
+                walk["jobs"] += 1
+                yield file, relative, stale, skip_digest
+            else:
+                walk["up_to_date"] += 1
+
+        manifest.touch(touched, run_id)
+        walk["done"] = True
+
+    files_count = 0
+    files_failed = 0
+
+    report = RunReport(args.trace, args.report_slowest)
 
-    with ProcessPoolExecutor(max_workers=(cpu_count()-1)) as ex:
-        files_count = 0
-        for _ in ex.map(ffmpeg_run, files, repeat(codec), repeat(destination), repeat(quality), repeat(forvo), repeat(config), repeat(args.no_normalize), repeat(args.no_silence_remove)):
-            files_count += 1
-            print(f"-PROGRESS: {files_count}/{files_total}", end="\r", flush=True)
+    def handle_result(relative: Path, file_targets: list[Target], result: FileResult):
+        nonlocal files_count, files_failed
+        files_count += 1
+        report.add(result)
+        if result["quarantine"] is not None:
+            quarantined.append({"file": result["file"], "reason": result["quarantine"], "encoded": result["ok"]})
+        if result["quarantine"] is not None and not result["ok"]:
+            # not encoded: the outputs of an earlier build are left to the next run, which prunes them if the file is still flagged
+            manifest.quarantine(result["file"], result["quarantine"], run_id)
+        elif result["ok"]:
+            # encoded, flagged or not (--no-quarantine): recorded like any other output, so the next run skips it
+            manifest.unquarantine(result["file"])
+            manifest.record(
+                result,
+                [str(output_path(relative, target)) for target in file_targets],
+                [settings[targets.index(target)] for target in file_targets],
+                run_id,
+            )
+        elif result["quarantine"] is None:
+            files_failed += 1
+            # a failure says nothing about the file, the outputs of a file quarantined before are kept too
+            manifest.touch([str(output_path(relative, target)) for target in targets], run_id)
+        files_total = walk["jobs"] if walk["done"] else "?"
+        print(f"-PROGRESS: {files_count}/{files_total}", end="\r", flush=True)
+
+    jobs = iter_jobs()
+    schedule = {"order_seconds": 0.0, "first_dispatch": None, "last_dispatch": None, "end": None, "job_seconds": []}
+    jobserver = None if args.jobserver is None else JobServer(args.jobserver)
+    if args.order != "walk":
+        # LPT needs every cost up front, so the streaming walk is traded for a list of the stale files
+        order_start = default_timer()
+        jobs = order_jobs(list(jobs), args.order, config, args.jobs, jobserver, args.history)
+        schedule["order_seconds"] = default_timer() - order_start
+        print(f"-Ordered {len(jobs)} files by {args.order} in {schedule['order_seconds']:.1f}s")
+
+    async def run_jobs():
+        # bounds the number of files in flight (and ffmpeg processes running),
+        # discovery only continues once a slot is free, so memory stays flat no matter how large the input tree is
+        slots = asyncio.Semaphore(max(1, args.jobs))
+        tasks = set()
+
+        async def run_job(batch, token):
+            job_start = default_timer()
+            try:
+                if args.batch > 1:
+                    results, retried = await ffmpeg_run_batch(batch, config, args.no_normalize, args.no_silence_remove, cache, not args.no_quarantine)
+                    report.add_batch(retried)
+                else:
+                    file, relative, file_targets, skip_digest = batch[0]
+                    results = [await ffmpeg_run(file, file_targets, relative, config, args.no_normalize, args.no_silence_remove, cache, skip_digest,
+                                                not args.no_quarantine)]
+                for (_, relative, file_targets, _), result in zip(batch, results):
+                    handle_result(relative, file_targets, result)
+            finally:
+                schedule["job_seconds"].append(default_timer() - job_start)
+                schedule["end"] = default_timer()
+                if token is not None:
+                    jobserver.release(token)
+                slots.release()
+
+        def iter_batches():
+            batch = []
+            for job in jobs:
+                batch.append(job)
+                if len(batch) >= args.batch:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        # a batch is a single ffmpeg process at a time, so it takes one slot (and token) like a single file
+        for batch in iter_batches():
+            await slots.acquire()
+            token = None if jobserver is None else await jobserver.acquire()
+            schedule["last_dispatch"] = default_timer()
+            if schedule["first_dispatch"] is None:
+                schedule["first_dispatch"] = schedule["last_dispatch"]
+            task = asyncio.create_task(run_job(batch, token))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # the walk is complete, so the remaining progress has a total
+        if walk["up_to_date"]:
+            print(f"\n-Skipped {walk['up_to_date']} up to date files")
+        if walk["excluded"]:
+            print(f"\n-Skipped {walk['excluded']} excluded files")
+        for exclusion in exclusions.unmatched():
+            print(f"\n-WARNING: the exclusion {exclusion['pattern']} ({exclusion['reason']}) matched no file")
+        await asyncio.gather(*tasks)
+
+    try:
+        asyncio.run(run_jobs())
+    finally:
+        report.close()
+
+    removed = sum(manifest.prune(target["destination"], run_id) for target in targets)
+    if removed:
+        print(f"\n-Removed {removed} outputs whose source no longer exists (or is excluded, or still quarantined)")
 
     elapsed = default_timer() - start
 
+    if cache is not None:
+        evicted = cache.evict(args.cache_max_entries)
+        if evicted:
+            print(f"\n-Evicted {evicted} analysis cache entries")
+
+    files_failed += walk["missing"]
     print(f"\n-Number of files processed: {files_count}")
+    if files_failed:
+        print(f"-Number of files failed: {files_failed}")
+    write_quarantine_report(quarantine_path, quarantined)
+    if quarantined:
+        print(f"-Quarantined {len(quarantined)} files (see {quarantine_path})")
     print(f"-ELAPSED TIME: {elapsed/60:.3}m {elapsed%60:.3}s")
+    report.print_summary(elapsed)
+    if schedule["first_dispatch"] is not None:
+        report.print_schedule(
+            args.order, args.jobs, schedule["end"] - schedule["first_dispatch"], schedule["end"] - schedule["last_dispatch"],
+            schedule["job_seconds"], schedule["order_seconds"],
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,235 @@
+"""
+Acoustic fingerprints to find near-duplicate recordings (jpod_index.py --near-duplicates).
+
+md5 only finds byte identical files, but the same recording also shows up re-encoded,
+or with a different header. Every file is decoded to low rate mono PCM and gets:
+- sub-fingerprints: 32 bits per 11.6ms frame, the signs of the energy differences between
+  33 bands and between consecutive frames (Haitsma & Kalker), robust to re-encoding
+- a summary: the log band energies averaged over 16 segments of the non-silent region
+
+Candidates come from a locality sensitive hash of the summaries (random hyperplanes, banded),
+multi-probed: clips are compared if they land in the same bucket, or in buckets one bit apart, of any band.
+Every pair is compared once, in the first band that makes it a candidate. A candidate pair is a near duplicate
+if the bit error rate of the sub-fingerprints, at the best alignment within MAX_SHIFT frames, is at most MAX_BER.
+
+Requires numpy.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import subprocess
+from itertools import combinations
+from typing import NamedTuple, TypedDict
+
+import numpy as np
+
+FINGERPRINT_VERSION = 1
+SAMPLE_RATE = 5512
+FRAME = 2048  # 370ms
+HOP = 64  # 11.6ms
+BAND_EDGES = np.geomspace(300, 2000, 34)  # 33 bands -> 32 bits per frame
+# frames quieter than the loudest frame by this much are silence, relative so that gain changes don't move the bounds
+SILENCE_DB = 30.0
+
+SUMMARY_SEGMENTS = 16
+# a pair is a candidate if all the rows of at least one band but one are equal. 16 bit keys (65536 buckets
+# per band) keep unrelated clips apart, while probing the 16 neighbouring buckets and 20 bands
+# still find a re-encode (summary cosine > ~0.9) with near certainty
+LSH_BANDS = 20
+LSH_ROWS = 16
+SIGNATURE_BITS = LSH_BANDS * LSH_ROWS
+# buckets this large are mostly noise/silence, comparing all their pairs would be quadratic
+MAX_BUCKET = 256
+
+MAX_SHIFT = 8  # ~93ms, covers encoder delay and padding differences
+MAX_BER = 0.15  # false merges drop audio, so this errs on the side of keeping both
+MAX_DURATION_DIFF = 0.1  # relative
+
+
+class Fingerprint(TypedDict):
+    duration: float
+    bits: np.ndarray  # uint32 sub-fingerprint per frame
+    summary: np.ndarray  # unit length float32 vector
+
+
+def decode(file: str, ffmpeg: str = "ffmpeg") -> np.ndarray:
+    cmd = [ffmpeg, "-hide_banner", "-nostats", "-loglevel", "error", "-i", file,
+           "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "f32le", "-"]
+    proc = subprocess.run(cmd, capture_output=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"decode failed ({proc.returncode}): {proc.stderr.decode('utf-8', errors='replace').strip()}")
+    return np.frombuffer(proc.stdout, dtype="<f4")
+
+
+def band_energies(samples: np.ndarray) -> np.ndarray:
+    """
+    (frames, 33) band energies of the non-silent region
+    """
+    # centered frames: frame i covers the samples around i * HOP
+    samples = np.pad(samples, (FRAME // 2, FRAME // 2))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME)[::HOP]
+
+    # drops the leading/trailing silence, so different amounts of padding still align
+    with np.errstate(divide="ignore"):
+        level = 10 * np.log10(np.mean(frames[:, FRAME // 2 - HOP:FRAME // 2 + HOP] ** 2, axis=1))
+    loud = np.flatnonzero(level > level.max() - SILENCE_DB)
+    if len(loud):
+        frames = frames[loud[0]:loud[-1] + 1]
+
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FRAME), axis=1)) ** 2
+    bins = np.searchsorted(np.fft.rfftfreq(FRAME, 1 / SAMPLE_RATE), BAND_EDGES)
+    return np.add.reduceat(spectrum, bins[:-1], axis=1)[:, :len(BAND_EDGES) - 1]
+
+
+def fingerprint_pcm(samples: np.ndarray) -> Fingerprint:
+    energies = band_energies(samples)
+
+    diff = energies[:, :-1] - energies[:, 1:]
+    bits = diff[1:] - diff[:-1] > 0
+    if len(bits) == 0:
+        bits = np.zeros((1, 32), dtype=bool)
+    packed = bits.astype(np.uint32) @ (np.uint32(1) << np.arange(32, dtype=np.uint32))
+
+    log_energies = np.log10(energies + 1e-10)
+    segments = np.array_split(log_energies, min(SUMMARY_SEGMENTS, len(log_energies)))
+    summary = np.stack([segment.mean(axis=0) for segment in segments])
+    if len(summary) < SUMMARY_SEGMENTS:
+        summary = np.pad(summary, ((0, SUMMARY_SEGMENTS - len(summary)), (0, 0)), mode="edge")
+    summary = (summary - summary.mean()).ravel()
+    summary /= np.linalg.norm(summary) or 1.0
+
+    return {
+        # of the non-silent region
+        "duration": len(energies) * HOP / SAMPLE_RATE,
+        "bits": packed.astype(np.uint32),
+        "summary": summary.astype(np.float32),
+    }
+
+
+def fingerprint_file(file: str, ffmpeg: str = "ffmpeg") -> Fingerprint:
+    return fingerprint_pcm(decode(file, ffmpeg))
+
+
+def bit_error_rate(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    lowest fraction of differing bits over the alignments within MAX_SHIFT frames
+    """
+    best = 1.0
+    min_overlap = max(1, int(0.8 * min(len(a), len(b))))
+    for shift in range(-MAX_SHIFT, MAX_SHIFT + 1):
+        x = a[max(shift, 0):]
+        y = b[max(-shift, 0):]
+        n = min(len(x), len(y))
+        if n < min_overlap:
+            continue
+        errors = np.unpackbits((x[:n] ^ y[:n]).view(np.uint8)).sum()
+        best = min(best, errors / (32 * n))
+    return best
+
+
+def is_near_duplicate(a: Fingerprint, b: Fingerprint) -> bool:
+    longest = max(a["duration"], b["duration"])
+    if longest > 0 and abs(a["duration"] - b["duration"]) / longest > MAX_DURATION_DIFF:
+        return False
+    return bit_error_rate(a["bits"], b["bits"]) <= MAX_BER
+
+
+class NearDuplicates(NamedTuple):
+    pairs: list[tuple[int, int]]
+    # sizes of the buckets over MAX_BUCKET, whose clips were only compared through other bands
+    skipped_buckets: list[int]
+
+
+def lsh_keys(summaries: np.ndarray) -> np.ndarray:
+    """
+    (clips, LSH_BANDS) bucket keys, LSH_ROWS random hyperplane bits each
+    """
+    planes = np.random.default_rng(FINGERPRINT_VERSION).standard_normal((summaries.shape[1], SIGNATURE_BITS))
+    bits = (summaries @ planes > 0).reshape(len(summaries), LSH_BANDS, LSH_ROWS)
+    return bits.astype(np.uint32) @ (np.uint32(1) << np.arange(LSH_ROWS, dtype=np.uint32))
+
+
+def find_near_duplicates(fingerprints: list[Fingerprint | None]) -> NearDuplicates:
+    """
+    returns the (i, j) index pairs of near-duplicate fingerprints (None entries are skipped)
+    """
+    valid = [i for i, fp in enumerate(fingerprints) if fp is not None]
+    if len(valid) < 2:
+        return NearDuplicates([], [])
+    keys = lsh_keys(np.stack([fingerprints[i]["summary"] for i in valid]))
+
+    buckets: dict[tuple[int, int], list[int]] = {}
+    for position, row_keys in enumerate(keys):
+        for band, key in enumerate(row_keys.tolist()):
+            buckets.setdefault((band, key), []).append(position)
+
+    probed = np.zeros(keys.shape, dtype=bool)
+    skipped_buckets = []
+    for (band, _), members in buckets.items():
+        if len(members) > MAX_BUCKET:
+            skipped_buckets.append(len(members))
+        else:
+            probed[members, band] = True
+
+    def candidates(band, key, members):
+        yield from combinations(members, 2)
+        for row in range(LSH_ROWS):
+            # each pair of neighbouring buckets once, from the lower key
+            neighbour = key ^ (1 << row)
+            others = buckets.get((band, neighbour))
+            if neighbour < key or others is None or not probed[others[0], band]:
+                continue
+            yield from ((min(a, b), max(a, b)) for a in members for b in others)
+
+    pairs = []
+    for (band, key), members in buckets.items():
+        if not probed[members[0], band]:
+            continue
+        for a, b in candidates(band, key, members):
+            # skips the pairs that already were candidates in an earlier band, so no pair is compared twice
+            diff = keys[a, :band] ^ keys[b, :band]
+            if np.any((diff & (diff - 1) == 0) & probed[a, :band] & probed[b, :band]):
+                continue
+            if is_near_duplicate(fingerprints[valid[a]], fingerprints[valid[b]]):
+                pairs.append((valid[a], valid[b]))
+    return NearDuplicates(sorted(pairs), sorted(skipped_buckets, reverse=True))
+
+
+class FingerprintCache:
+    """
+    fingerprints by content digest, so unchanged files are not decoded again
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "digest TEXT PRIMARY KEY, version INTEGER NOT NULL, duration REAL NOT NULL, bits BLOB NOT NULL, summary BLOB NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, digest: str) -> Fingerprint | None:
+        row = self.conn.execute(
+            "SELECT duration, bits, summary FROM fingerprints WHERE digest = ? AND version = ?", (digest, FINGERPRINT_VERSION)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "duration": row[0],
+            "bits": np.frombuffer(row[1], dtype=np.uint32),
+            "summary": np.frombuffer(row[2], dtype=np.float32),
+        }
+
+    def put_many(self, entries: list[tuple[str, Fingerprint]]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)",
+                (
+                    (digest, FINGERPRINT_VERSION, fp["duration"], fp["bits"].tobytes(), fp["summary"].tobytes())
+                    for digest, fp in entries
+                ),
+            )
@@ -14,18 +14,29 @@ Requires Python 3.11 to use NotRequired
 
 import os
 import json
-import shutil
+import time
+import random
+import sqlite3
 import hashlib
 import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from dataclasses import dataclass
 from pathlib import Path
-from typing import TypedDict, NewType, NotRequired, Any
+from typing import TypedDict, NewType, NotRequired, Any, Iterable, Iterator
+
+from ffmpegmulti import EXCLUSIONS, ExclusionList
 
 # TypedDict classes and FileList copied/pasted from AJT Japanese
 
-TEMP_INDEX = "temp/jpod/temp_index.json"
+# md5 groups between the hashing and the AJT index, see write_temp_index
+TEMP_INDEX = "temp/jpod/temp_index.sqlite"
 OUT_INDEX = "temp/jpod/index.json"
-OUT_MEDIA = "temp/jpod/media"
+HASH_CACHE = "temp/jpod/hash_cache.sqlite"
+FINGERPRINT_CACHE = "temp/jpod/fingerprint_cache.sqlite"
+# [original file, media/<md5>.mp3] pairs, encoded by `ffmpegmulti.py temp/jpod/media_manifest.json ...`
+OUT_MANIFEST = "temp/jpod/media_manifest.json"
 
 
 FileList = list[str]
@@ -71,6 +82,13 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--no-jpod-index-gen", action="store_true")
     parser.add_argument("--no-index-gen", action="store_true")
+    parser.add_argument("--jobs", type=int, default=cpu_count(), help="number of files hashed in parallel")
+    parser.add_argument("--no-hash-cache", action="store_true", help="rehash every file, without reading or writing the hash cache")
+    parser.add_argument("--verify-hash-cache", type=int, default=0, metavar="N",
+                        help="rehashes N random cache hits, and discards the cache if any of them changed")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="also merges recordings that only differ by their encoding (acoustic fingerprints, requires numpy)")
+    parser.add_argument("--ffmpeg", type=str, default="ffmpeg", help="used to decode files for --near-duplicates")
     return parser.parse_args()
 
 def is_supported_audio_file(path):
@@ -89,15 +107,17 @@ def is_supported_audio_file(path):
     return True
 
 
-def parse_directory(input_dir: str, index: JpodIndex):
+def parse_directory(input_dir: str, exclusions: ExclusionList) -> list[TermInfo]:
+    """
+    returns the parsed file names of the directory, in walk order (not hashed yet)
+    """
+    terms: list[TermInfo] = []
     # copy/paste from local audio add-on
     for path in filter(is_supported_audio_file, Path(input_dir).rglob("*")):
         relative_path = str(path.relative_to(Path(input_dir).parent))
-        # Remove known broken files
-        if relative_path in ("jpod_files/かえる - 蛙.mp3", "jpod_files/きゅうりょうび - 給料日.mp3",
-                             "jpod_files/ひとり - 一人.mp3", "jpod_files/くばる - 配る.mp3",
-                             "jpod_files/せいえん - 声援.mp3", "jpod_files/こうこく - 広告.mp3"):
-            print(f"Excluding known broken file {relative_path}")
+        reason = exclusions.reason(path)
+        if reason is not None:
+            print(f"Excluding {relative_path} ({reason})")
             continue
 
         basename_noext = path.stem
@@ -117,28 +137,251 @@ def parse_directory(input_dir: str, index: JpodIndex):
         if reading == term and not is_kana(reading):
             reading = None
 
-        # checksums: https://stackoverflow.com/a/16876405
-        with open(path, 'rb') as f:
-            data = f.read()
-            md5 = hashlib.md5(data).hexdigest()
+        terms.append({"term": term, "reading": reading, "file": str(path)})
+    return terms
+
+
+def file_md5(path: str) -> str:
+    """
+    hashes in fixed size chunks, so memory stays constant regardless of the file size
+    """
+    # checksums: https://stackoverflow.com/a/16876405
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, "md5").hexdigest()
+
+
+class HashCache:
+    """
+    md5 of every input file, keyed by (path, size, mtime_ns, inode).
+    A file whose stat didn't change since the last run isn't read again.
+    """
 
-            # ASSUMPTION: a unique md5 == unique file contents
-            # (should be safe to assume since we're not dealing with petabytes of data,
-            # and we're not dealing with potentially adverse data)
-            if md5 not in index:
-                index[md5] = []
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, "
+            "md5 TEXT NOT NULL, last_run INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def key(stat: os.stat_result) -> tuple[int, int, int]:
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, path: str, stat: os.stat_result) -> str | None:
+        row = self.conn.execute("SELECT size, mtime_ns, inode, md5 FROM hashes WHERE path = ?", (path,)).fetchone()
+        if row is None or tuple(row[:3]) != self.key(stat):
+            return None
+        return row[3]
+
+    def put_many(self, entries: list[tuple[str, os.stat_result, str]], run_id: int):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                ((path, *self.key(stat), md5, run_id) for path, stat, md5 in entries),
+            )
 
-            index[md5].append({"term": term, "reading": reading, "file": str(path)})
+    def prune(self, run_id: int):
+        """
+        forgets the files that were not seen in this run
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM hashes WHERE last_run != ?", (run_id,))
 
-def add_terms_to_ajt_index(terms: list[TermInfo], ajt_index: SourceIndex, md5: str, reading_override: str | None = None):
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM hashes")
+
+
+def hash_files(files: list[str], jobs: int, cache: HashCache | None, verify_sample: int) -> list[str]:
+    """
+    returns the md5 of every file, in order
+    """
+    # NOTE: every file is hashed, including files with a unique size,
+    # because the md5 is also the media file name in the published index
+    stats = [os.stat(file) for file in files]
+    md5s: list[str | None] = [None] * len(files)
+    if cache is not None:
+        md5s = [cache.get(file, stat) for file, stat in zip(files, stats)]
+
+        hits = [i for i, md5 in enumerate(md5s) if md5 is not None]
+        sample = random.sample(hits, min(verify_sample, len(hits)))
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as ex:
+            mismatches = [i for i, md5 in zip(sample, ex.map(file_md5, (files[i] for i in sample))) if md5 != md5s[i]]
+        if mismatches:
+            print(f"(jpod_index) WARNING: {len(mismatches)}/{len(sample)} sampled cache entries are outdated "
+                  f"(e.g. {files[mismatches[0]]}), discarding the hash cache")
+            cache.clear()
+            md5s = [None] * len(files)
+        elif sample:
+            print(f"(jpod_index) verified {len(sample)} hash cache entries")
+
+    misses = [i for i, md5 in enumerate(md5s) if md5 is None]
+    # hashlib releases the GIL, so threads hash files in parallel
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as ex:
+        for i, md5 in zip(misses, ex.map(file_md5, (files[i] for i in misses))):
+            md5s[i] = md5
+    print(f"(jpod_index) hashed {len(misses)} files, {len(files) - len(misses)} unchanged")
+
+    if cache is not None:
+        run_id = time.time_ns()
+        cache.put_many(list(zip(files, stats, md5s)), run_id)
+        cache.prune(run_id)
+    return md5s
+
+
+def hash_terms(terms: list[TermInfo], index: JpodIndex, jobs: int, cache: HashCache | None, verify_sample: int):
+    # the walk order is kept, so the index is identical to a serial run
+    md5s = hash_files([t["file"] for t in terms], jobs, cache, verify_sample)
+    for term_info, md5 in zip(terms, md5s):
+        # ASSUMPTION: a unique md5 == unique file contents
+        # (should be safe to assume since we're not dealing with petabytes of data,
+        # and we're not dealing with potentially adverse data)
+        if md5 not in index:
+            index[md5] = []
+
+        index[md5].append(term_info)
+
+def merge_near_duplicates(index: JpodIndex, jobs: int, ffmpeg: str) -> JpodIndex:
+    """
+    merges the md5 groups whose audio is a near duplicate, so parse_index sees them as a single file.
+    The merged group keeps the md5 (and file) of its first group in index order, i.e. jpod_files first.
+    """
+    try:
+        import fingerprint
+    except ImportError as e:
+        raise RuntimeError("--near-duplicates requires numpy (pip install numpy)") from e
+
+    md5s = list(index)
+    cache = fingerprint.FingerprintCache(FINGERPRINT_CACHE)
+    fingerprints = [cache.get(md5) for md5 in md5s]
+    missing = [i for i, fp in enumerate(fingerprints) if fp is None]
+
+    def compute(i):
+        try:
+            return fingerprint.fingerprint_file(index[md5s[i]][0]["file"], ffmpeg)
+        except Exception as e:
+            print(f"(jpod_index) cannot fingerprint {index[md5s[i]][0]['file']}: {e}")
+            return None
+
+    # decoding runs in ffmpeg and the FFTs release the GIL
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as ex:
+        for i, fp in zip(missing, ex.map(compute, missing)):
+            fingerprints[i] = fp
+    cache.put_many([(md5s[i], fingerprints[i]) for i in missing if fingerprints[i] is not None])
+
+    # union-find over the near-duplicate pairs, the root is always the earliest group
+    parent = list(range(len(md5s)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    near_duplicates = fingerprint.find_near_duplicates(fingerprints)
+    if near_duplicates.skipped_buckets:
+        sizes = near_duplicates.skipped_buckets
+        print(f"(jpod_index) WARNING: skipped {len(sizes)} LSH buckets over {fingerprint.MAX_BUCKET} files "
+              f"(largest {sizes[0]}, {sum(sizes)} entries), their files were only compared through other bands")
+    for i, j in near_duplicates.pairs:
+        a, b = find(i), find(j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    merged: JpodIndex = {}
+    for i, md5 in enumerate(md5s):
+        root = md5s[find(i)]
+        if root not in merged:
+            merged[root] = []
+        merged[root].extend(index[md5])
+    print(f"(jpod_index) merged {len(md5s) - len(merged)} near duplicate files")
+    return merged
+
+
+def write_temp_index(path: str, index: JpodIndex):
+    """
+    Stores the index as SQLite, under a temporary name renamed once complete:
+    a row per md5 group (in index order, looked up by md5 through an index),
+    and a row per term, with the directory of its file stored only once.
+    """
+    partial = path + ".tmp"
+    if os.path.exists(partial):
+        os.remove(partial)
+    conn = sqlite3.connect(partial)
+    # a failed write is thrown away, so there is nothing to journal
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE dirs (id INTEGER PRIMARY KEY, path TEXT NOT NULL)")
+    conn.execute("CREATE TABLE groups (id INTEGER PRIMARY KEY, md5 TEXT NOT NULL)")
+    conn.execute(
+        "CREATE TABLE terms ("
+        "group_id INTEGER NOT NULL REFERENCES groups (id), position INTEGER NOT NULL, term TEXT NOT NULL, reading TEXT, "
+        "dir_id INTEGER NOT NULL REFERENCES dirs (id), name TEXT NOT NULL, PRIMARY KEY (group_id, position)) WITHOUT ROWID"
+    )
+
+    dirs: dict[str, int] = {}
+
+    def term_rows():
+        for group_id, md5 in enumerate(index):
+            for position, term_info in enumerate(index[md5]):
+                directory, name = os.path.split(term_info["file"])
+                if directory not in dirs:
+                    dirs[directory] = len(dirs)
+                yield group_id, position, term_info["term"], term_info["reading"], dirs[directory], name
+
+    conn.executemany("INSERT INTO groups VALUES (?, ?)", enumerate(index))
+    conn.executemany("INSERT INTO terms VALUES (?, ?, ?, ?, ?, ?)", term_rows())
+    conn.executemany("INSERT INTO dirs VALUES (?, ?)", ((i, directory) for directory, i in dirs.items()))
+    conn.execute("CREATE UNIQUE INDEX groups_md5 ON groups (md5)")
+    conn.commit()
+    conn.close()
+    os.replace(partial, path)
+
+
+def iter_temp_index(path: str) -> Iterator[tuple[CheckSum, list[TermInfo]]]:
+    """
+    streams the (md5, terms) groups of the temp index in index order, one group in memory at a time
+    """
+    # read only, so a missing index isn't silently created empty
+    if not os.path.isfile(path):
+        raise RuntimeError(f"{path} doesn't exist (the temp_index.json of older versions isn't read anymore), "
+                           "run without --no-jpod-index-gen first")
+    conn = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        try:
+            dirs = dict(conn.execute("SELECT id, path FROM dirs"))
+        except sqlite3.DatabaseError as e:
+            raise RuntimeError(f"{path} is not a temp index ({e}), run without --no-jpod-index-gen first") from e
+        # the terms primary key is (group_id, position), so this walks both tables in order without sorting
+        rows = conn.execute(
+            "SELECT groups.md5, terms.term, terms.reading, terms.dir_id, terms.name "
+            "FROM groups JOIN terms ON terms.group_id = groups.id ORDER BY groups.id, terms.position"
+        )
+        for md5, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield md5, [
+                {"term": term, "reading": reading, "file": os.path.join(dirs[dir_id], name)}
+                for _, term, reading, dir_id, name in group
+            ]
+    finally:
+        conn.close()
+
+
+def add_terms_to_ajt_index(terms: list[TermInfo], ajt_index: SourceIndex, media_manifest: list[tuple[str, str]], md5: str, reading_override: str | None = None):
     assert len(terms) > 0
 
     reading = reading_override
     og_file_name = terms[0]["file"]
     new_file_name = md5 + ".mp3" # NOTE: hard coded mp3 because original files should all be mp3
-    # It's okay for wav files to have a .mp3 extension for this temporary purpose. ffmpeg will detect by file content.
-    shutil.copy(og_file_name, os.path.join(OUT_MEDIA, new_file_name))
+    # the original is encoded in place by ffmpegmulti, which replaces the suffix per codec
+    media_manifest.append((og_file_name, os.path.join(ajt_index["meta"]["media_dir"], new_file_name)))
 
+    # new_file_name is only added by this call (its md5 is unique), so it can only already be
+    # in the list of a headword that was seen earlier in this group
+    added_terms = set()
     for term_info in terms:
         # gets the first reading from the terms
         # ASSUMPTION: readings are unique (see parse_index for this parsing)
@@ -146,10 +389,12 @@ def add_terms_to_ajt_index(terms: list[TermInfo], ajt_index: SourceIndex, md5: s
             reading = term_info.get("reading", None)
 
         term = term_info["term"]
+        if term in added_terms:
+            continue
+        added_terms.add(term)
         if term not in ajt_index["headwords"]:
             ajt_index["headwords"][term] = []
-        if new_file_name not in ajt_index["headwords"][term]:
-            ajt_index["headwords"][term].append(new_file_name)
+        ajt_index["headwords"][term].append(new_file_name)
 
     file_info: Any = {} # Any because I'm too lazy to get typing to work here
     if reading is not None:
@@ -161,7 +406,7 @@ def add_terms_to_ajt_index(terms: list[TermInfo], ajt_index: SourceIndex, md5: s
 
 
 
-def parse_index(index: JpodIndex):
+def parse_index(groups: Iterable[tuple[CheckSum, list[TermInfo]]]):
     # counts the number of words that are removed
     counter = 0
 
@@ -176,13 +421,13 @@ def parse_index(index: JpodIndex):
         "headwords": {},
         "files": {},
     }
+    media_manifest: list[tuple[str, str]] = []
 
-    for md5 in index:
+    for md5, terms in groups:
         ajt_reading = None
 
         jpod_counter = 0
         readings = set()
-        terms = index[md5]
         for term_info in terms:
             reading = term_info["reading"]
             if reading is not None and reading not in readings:
@@ -194,7 +439,7 @@ def parse_index(index: JpodIndex):
                 ajt_reading = term_info["reading"]
 
         if len(readings) >= 2:
-            #print(index[md5])
+            #print(terms)
             if jpod_counter > 1:
                 jpod_audio_unique += 1
                 # we do NOT add the audio here, because there are multiple readings,
@@ -203,44 +448,50 @@ def parse_index(index: JpodIndex):
             elif jpod_counter == 1:
                 # ASSUMPTION: jpod source has the correct reading
                 assert ajt_reading is not None
-                add_terms_to_ajt_index(terms, ajt_index, md5, ajt_reading)
+                add_terms_to_ajt_index(terms, ajt_index, media_manifest, md5, ajt_reading)
             else:
                 counter += len(readings)
 
         else:
             # unique reading for the word, safe to use!
-            add_terms_to_ajt_index(terms, ajt_index, md5)
+            add_terms_to_ajt_index(terms, ajt_index, media_manifest, md5)
 
     print(f"Gold standard failures: {jpod_audio_unique}")
     print(f"Skipped duplicates: {counter}")
 
     with open(OUT_INDEX, "w") as f:
         json.dump(ajt_index, f, ensure_ascii=False, indent=2)
+    with open(OUT_MANIFEST, "w") as f:
+        json.dump(media_manifest, f, ensure_ascii=False, indent=2)
 
-def create_jpod_index():
+def create_jpod_index(jobs: int, cache: HashCache | None, verify_sample: int, near_duplicates: bool, ffmpeg: str):
     index: JpodIndex = {}
-    parse_directory("input/jpod_files", index)
-    parse_directory("input/jpod_alternate_files", index)
-    with open(TEMP_INDEX, "w") as f:
-        json.dump(index, f, ensure_ascii=False, indent=2)
+    # the same list ffmpegmulti skips, see excluded_files.json
+    exclusions = ExclusionList(str(EXCLUSIONS))
+    terms = parse_directory("input/jpod_files", exclusions) + parse_directory("input/jpod_alternate_files", exclusions)
+    for exclusion in exclusions.unmatched():
+        print(f"WARNING: the exclusion {exclusion['pattern']} ({exclusion['reason']}) matched no file")
+    hash_terms(terms, index, jobs, cache, verify_sample)
+    if near_duplicates:
+        index = merge_near_duplicates(index, jobs, ffmpeg)
+    write_temp_index(TEMP_INDEX, index)
 
 def main():
     # Create required directories if they don't exist
-    os.makedirs(OUT_MEDIA, exist_ok=True)
+    os.makedirs(os.path.dirname(OUT_INDEX), exist_ok=True)
 
     args = get_args()
 
     if not args.no_jpod_index_gen:
-        create_jpod_index()
+        cache = None if args.no_hash_cache else HashCache(HASH_CACHE)
+        create_jpod_index(args.jobs, cache, args.verify_hash_cache, args.near_duplicates, args.ffmpeg)
 
     # creates ajt japanese index file
     # NOTE: a unique file must be created per reading.
     # However, our data occasionally has one file for multiple readings.
     # These will be emitted as a warning.
     if not args.no_index_gen:
-        with open(TEMP_INDEX) as f:
-            index = json.load(f)
-        parse_index(index)
+        parse_index(iter_temp_index(TEMP_INDEX))
 
 if __name__ == "__main__":
     main()
@@ -1,15 +1,28 @@
 """
-Generates jmdict_forms.json
+Generates jmdict_forms.json, and jmdict_forms.sqlite with the same groups indexed by reading and by kanji:
+
+    -- spellings that share a reading
+    SELECT e.kanji, e.override_reading FROM groups g JOIN expressions e ON e.group_id = g.id WHERE g.reading = ?
+    -- readings of a spelling
+    SELECT DISTINCT g.reading FROM expressions e JOIN groups g ON g.id = e.group_id WHERE e.kanji = ?
 """
 
+import io
+import os
 import json
+import shutil
+import sqlite3
+import argparse
 from collections import defaultdict
-from typing import TypedDict, NotRequired
+from multiprocessing import Pool, cpu_count
+from typing import TypedDict, NotRequired, Iterator
 import xml.etree.ElementTree as ET
 
 JMDICT_PATH = 'temp/JMdict_e'
 OUTPUT_JSON_OPUS_COLLECTION = "output/opus/user_files/jmdict_forms.json"
 OUTPUT_JSON_MP3_COLLECTION = "output/mp3/user_files/jmdict_forms.json"
+OUTPUT_SQLITE_OPUS_COLLECTION = "output/opus/user_files/jmdict_forms.sqlite"
+OUTPUT_SQLITE_MP3_COLLECTION = "output/mp3/user_files/jmdict_forms.sqlite"
 
 UK_TEXT = "word usually written using kana alone"
 UK_CUTOFF = 0.6 # % of words that must be usually kana to be considered usually kana
@@ -103,16 +116,173 @@ def get_readings_to_kanji(ele, filter_non_plural=True):
         result.append(result_pair)
     return result
 
+def iter_entries(source) -> Iterator[ET.Element]:
+    """
+    source is a path or a binary file object.
+    streams the children of the root element (the <entry> elements) as they are completed,
+    and frees each one afterwards, so memory doesn't grow with the size of JMdict
+    """
+    depth = 0
+    root = None
+    for event, ele in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = ele
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield ele
+            # drops the finished entry from the root as well, otherwise the root still references every entry
+            ele.clear()
+            root.clear()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=cpu_count(), help="number of shards processed in parallel")
+    parser.add_argument("--shard-size", type=int, default=4 * 1024 * 1024, help="approximate size of a shard in bytes")
+    return parser.parse_args()
+
+
+def get_shards(path: str, shard_size: int) -> tuple[bytes, list[tuple[int, int]]]:
+    """
+    splits the file into (start, end) byte ranges that each hold whole <entry> elements,
+    and returns them with the header (the prolog with the entity definitions, up to and including <JMdict>)
+    """
+    with open(path, "rb") as f:
+        data = f.read(1024 * 1024)
+        root_start = data.find(b"<JMdict>")
+        assert root_start != -1, "<JMdict> not found in the first MB of the file"
+        header = data[:root_start + len(b"<JMdict>")]
+
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 1024))
+        tail = f.read()
+        end = size - len(tail) + tail.rfind(b"</JMdict>")
+
+        def next_entry(position):
+            # "<entry>" can't appear in text or attributes (it would be escaped), so this is always an element boundary
+            while position < end:
+                f.seek(position)
+                chunk = f.read(64 * 1024)
+                found = chunk.find(b"<entry>")
+                if found != -1:
+                    return min(position + found, end)
+                # overlaps the reads, in case the tag is cut in half
+                position += len(chunk) - len(b"<entry>")
+            return end
+
+        bounds = [len(header)]
+        while bounds[-1] < end:
+            bounds.append(next_entry(bounds[-1] + shard_size))
+    return header, list(zip(bounds, bounds[1:]))
+
+
+def process_shard(args: tuple[str, bytes, int, int]) -> tuple[str, list[dict]]:
+    """
+    returns the items of the shard serialized the way json.dump(..., indent=2) writes list items, and the items themselves
+    """
+    path, header, start, end = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        document = header + f.read(end - start) + b"</JMdict>"
+    items = []
+    texts = []
+    for ele in iter_entries(io.BytesIO(document)):
+        for item in get_readings_to_kanji(ele):
+            items.append(item)
+            # the item is nested one level inside the list, so its lines are indented once more
+            texts.append("  " + json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n  "))
+    return ",\n".join(texts), items
+
+
+class FormsDatabase:
+    """
+    jmdict_forms.sqlite, written under a temporary name and renamed once complete
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.partial = path + ".tmp"
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        self.conn = sqlite3.connect(self.partial)
+        # a failed build is thrown away, so there is nothing to journal
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE groups (id INTEGER PRIMARY KEY, reading TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE expressions ("
+            "group_id INTEGER NOT NULL REFERENCES groups (id), position INTEGER NOT NULL, "
+            "kanji TEXT NOT NULL, override_reading TEXT, PRIMARY KEY (group_id, position)) WITHOUT ROWID"
+        )
+        self.group_id = 0
+
+    def add(self, items: list[dict]):
+        groups = []
+        expressions = []
+        for item in items:
+            self.group_id += 1
+            groups.append((self.group_id, item["reading"]))
+            expressions.extend(
+                (self.group_id, position, expression["kanji"], expression.get("override_reading"))
+                for position, expression in enumerate(item["expressions"])
+            )
+        self.conn.executemany("INSERT INTO groups VALUES (?, ?)", groups)
+        self.conn.executemany("INSERT INTO expressions VALUES (?, ?, ?, ?)", expressions)
+
+    def close(self):
+        # indexes are built once at the end, which is faster than updating them on every insert
+        self.conn.execute("CREATE INDEX groups_reading ON groups (reading)")
+        self.conn.execute("CREATE INDEX expressions_kanji ON expressions (kanji)")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+        self.conn.close()
+        os.replace(self.partial, self.path)
+
+
+def write_output(path: str, database: FormsDatabase, shards: Iterator[tuple[str, list[dict]]]):
+    """
+    the JSON is byte for byte the same file as json.dump(result, f, ensure_ascii=False, indent=2)
+    """
+    empty = True
+    with open(path, "w") as f:
+        for text, items in shards:
+            database.add(items)
+            if not text:
+                continue
+            f.write(("[\n" if empty else ",\n") + text)
+            empty = False
+        f.write("[]" if empty else "\n]")
+    database.close()
+
+
+def link_or_copy(src: str, dst: str):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
 def main():
-    tree = ET.parse(JMDICT_PATH)
-    root = tree.getroot()
-    result = []
-    for ele in root:
-        result.extend(get_readings_to_kanji(ele))
-    with open(OUTPUT_JSON_OPUS_COLLECTION, "w") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
-    with open(OUTPUT_JSON_MP3_COLLECTION, "w") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    args = get_args()
+    header, shards = get_shards(JMDICT_PATH, args.shard_size)
+    tasks = ((JMDICT_PATH, header, start, end) for start, end in shards)
+    database = FormsDatabase(OUTPUT_SQLITE_OPUS_COLLECTION)
+    if args.jobs > 1 and len(shards) > 1:
+        # imap returns the shards in order, while the workers parse ahead
+        with Pool(min(args.jobs, len(shards))) as pool:
+            write_output(OUTPUT_JSON_OPUS_COLLECTION, database, pool.imap(process_shard, tasks))
+    else:
+        write_output(OUTPUT_JSON_OPUS_COLLECTION, database, map(process_shard, tasks))
+
+    # serialized once, both collections get the same files
+    link_or_copy(OUTPUT_JSON_OPUS_COLLECTION, OUTPUT_JSON_MP3_COLLECTION)
+    link_or_copy(OUTPUT_SQLITE_OPUS_COLLECTION, OUTPUT_SQLITE_MP3_COLLECTION)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+"""
+NumPy analysis backend for ffmpegmulti (--analysis-backend numpy).
+
+Each file is decoded once to 48kHz float PCM over a pipe, and the silence runs and clipping
+are computed here instead of being scraped from the silencedetect / astats log output.
+The results have the same shape as the ffmpeg backend's, so ffmpegmulti's crop_bounds() is shared between both backends.
+The loudness is measured by loudnorm itself over the trimmed region with either backend (see ffmpegmulti.loudnorm_first_pass).
+
+The pipe carries nine channels:
+- 0: the audio downmixed to mono (clipping)
+- 1-8: the audio after af_pass (run at the source rate, like in the ffmpeg backend) upmixed to 7.1 (silence detection)
+
+Expected differences to the ffmpeg backend, checked by compare_analysis.py and tests/test_analysis_backends.py (see TOLERANCE):
+- silence bounds: within a few ms, af_pass's output is resampled to 48kHz before the detection
+- loudness: only differs by what the different bounds cut
+- clipping: the runs at full scale are counted on the 48kHz mono downmix, where resampling can shorten them,
+  instead of on every channel at the source rate (not compared, it only decides the quarantine)
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Optional
+
+import numpy as np
+
+SAMPLE_RATE = 48000
+# the audio downmixed to mono, then af_pass's output upmixed to 7.1 (see build_decode_cmd)
+CHANNELS = 9
+PIPE_FORMAT = f"aformat=sample_fmts=flt:sample_rates={SAMPLE_RATE}"
+# full scale once converted to 16 bit, and the shortest run of such samples that counts as clipping (see ffmpegmulti.parse_clipping)
+CLIP_LEVEL = 32767 / 32768
+CLIP_MIN_RUN = 3
+
+# maximum absolute difference accepted between the two backends, per field.
+# measured with compare_analysis.py on 120 generated speech clips (words to sentences, -30 to -1 dBFS, some clipped),
+# max (p95) differences: start 0.0084 (0), end 0.0014 (0), input_i 0.02 (0), input_lra 0.1 (0), input_tp 0.04 (0), input_thresh 0.02 (0).
+# loudnorm prints its values rounded to 0.01 (0.1 for lra), so the loudness only differs when the bounds do.
+TOLERANCE = {
+    "start": 0.015,
+    "end": 0.015,
+    "input_i": 0.1,
+    "input_lra": 0.2,
+    "input_tp": 0.1,
+    "input_thresh": 0.1,
+}
+
+rx_NOISE = re.compile(r'\b(?:n|noise)=(-?[\d.]+)(dB)?')
+rx_DURATION = re.compile(r'\b(?:d|duration)=([\d.]+)')
+
+
+def build_decode_cmd(file, config) -> str:
+    graph = (
+        f"[0:a]asplit=2[raw][p];[raw]{PIPE_FORMAT}:channel_layouts=mono[r];"
+        # silencedetect ends a silence as soon as any channel is above the threshold, and af_pass can change the layout
+        # (dialoguenhance outputs 3.0): upmixing to a fixed layout copies every channel as is, a downmix would sum them
+        f"[p]{config['af_pass']},{PIPE_FORMAT}:channel_layouts=7.1[ps];"
+        "[r][ps]amerge=inputs=2[out]"
+    )
+    arg_input = f"-i \"{file}\""
+    # info: the input header in the log tells a broken input from other failures (see ffmpegmulti.broken_input_reason)
+    return f'{config["ffmpeg"]} -hide_banner -nostats -loglevel info {arg_input} -filter_complex "{graph}" -map [out] -f f32le -'
+
+
+def silence_params(af_silence_detect: str) -> tuple[float, float]:
+    """
+    returns the (amplitude threshold, minimum duration) of the silencedetect filter string,
+    with the same defaults as ffmpeg
+    """
+    noise = 10 ** (-60 / 20)
+    match = rx_NOISE.search(af_silence_detect)
+    if match is not None:
+        noise = 10 ** (float(match.group(1)) / 20) if match.group(2) else float(match.group(1))
+
+    duration = 2.0
+    match = rx_DURATION.search(af_silence_detect)
+    if match is not None:
+        duration = float(match.group(1))
+
+    return noise, duration
+
+
+def detect_silences(signal: np.ndarray, noise: float, duration: float) -> list[tuple[float, Optional[float]]]:
+    """
+    same semantics as silencedetect: a run of samples below the threshold that lasts at least
+    duration seconds is reported as (silence_start, silence_end), with silence_end None if it lasts until the end
+    """
+    silent = np.abs(signal) < noise
+    if not silent.any():
+        return []
+    # run boundaries: +1 where a silent run starts, -1 where it ends
+    edges = np.diff(np.concatenate(([0], silent.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    min_samples = int(duration * SAMPLE_RATE)
+
+    silences: list[tuple[float, Optional[float]]] = []
+    for start, end in zip(starts, ends):
+        if end - start < min_samples:
+            continue
+        silences.append((float(start / SAMPLE_RATE), None if end == len(signal) else float(end / SAMPLE_RATE)))
+    return silences
+
+
+def clipped_fraction(signal: np.ndarray) -> float:
+    """
+    fraction of the samples in runs of at least CLIP_MIN_RUN samples at full scale
+    """
+    full_scale = np.abs(signal) >= CLIP_LEVEL
+    if not full_scale.any():
+        return 0.0
+    edges = np.diff(np.concatenate(([0], full_scale.view(np.int8), [0])))
+    runs = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    return float(runs[runs >= CLIP_MIN_RUN].sum() / len(signal))
+
+
+def analyze_pcm(pcm: bytes, config, detect_silence: bool) -> tuple[list[tuple[float, Optional[float]]], float, float]:
+    """
+    returns (silences, duration in seconds, clipped fraction) of the output of build_decode_cmd()
+    """
+    samples = np.frombuffer(pcm, dtype="<f4")
+    samples = samples[:len(samples) - len(samples) % CHANNELS].reshape(-1, CHANNELS)
+
+    silences = []
+    if detect_silence:
+        silences = detect_silences(np.abs(samples[:, 1:]).max(axis=1), *silence_params(config["af_silence_detect"]))
+
+    return silences, len(samples) / SAMPLE_RATE, clipped_fraction(samples[:, 0]) if len(samples) else 0.0
@@ -0,0 +1,98 @@
+"""
+The ffmpeg and numpy analysis backends of ffmpegmulti agree within pcm_analysis.TOLERANCE.
+
+The clips are generated with lavfi: a voiced tone (a few harmonics with a syllable rate envelope)
+between silences, at different levels and in different containers, and one clipped past full scale.
+The same check runs on real files with compare_analysis.py.
+Both backends are also run on the clips at the edges of the quarantine: too short to measure, and without any sample.
+"""
+
+import shutil
+import asyncio
+import subprocess
+
+import pytest
+
+import ffmpegmulti
+import compare_analysis
+import pcm_analysis
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+VOICE = "(sin(2*PI*140*t)+0.5*sin(2*PI*280*t)+0.3*sin(2*PI*420*t)+0.2*sin(2*PI*700*t))/2*(0.6+0.4*sin(2*PI*4*t))"
+
+# name: (lead silence, voiced, trail silence, gain, channels)
+CLIPS = {
+    "loud.mp3": (0.4, 1.5, 0.5, 0.9, 1),
+    "quiet.wav": (0.3, 1.8, 0.4, 0.03, 1),
+    "long.flac": (0.6, 3.5, 0.9, 0.3, 2),
+    "clipped.wav": (0.2, 1.4, 0.2, 4.0, 1),
+}
+
+
+def make_clip(path, lead: float, voiced: float, trail: float, gain: float, channels: int):
+    expr = f"if(between(t,{lead},{lead + voiced}),{gain}*{VOICE},0)"
+    source = f"aevalsrc='{'|'.join([expr] * channels)}':s=44100:d={lead + voiced + trail}"
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", source, str(path)], check=True)
+
+
+@pytest.fixture(scope="module")
+def analyses(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("clips")
+    config = dict(ffmpegmulti.get_config(), ffmpeg="ffmpeg")
+    result = {}
+    for name, params in CLIPS.items():
+        path = directory / name
+        make_clip(path, *params)
+        result[name] = [asyncio.run(ffmpegmulti.analyze_file(path, dict(config, analysis_backend=backend), False, False))
+                        for backend in ffmpegmulti.ANALYSIS_BACKENDS]
+    return result
+
+
+@pytest.mark.parametrize("name", CLIPS)
+def test_backends_agree(analyses, name):
+    diffs = compare_analysis.compare_fields(*analyses[name])
+    assert set(diffs) == set(pcm_analysis.TOLERANCE)
+    for key, diff in diffs.items():
+        assert diff <= pcm_analysis.TOLERANCE[key], (key, analyses[name])
+
+
+@pytest.mark.parametrize("name", CLIPS)
+def test_bounds_follow_the_silences(analyses, name):
+    lead, voiced, trail, gain, channels = CLIPS[name]
+    compensate = ffmpegmulti.get_config()["silence_compensate"]
+    for analysis in analyses[name]:
+        # the voice is kept and the silences are cut down to silence_compensate,
+        # give or take the ~0.1s by which af_pass's filters move the voiced edges
+        assert lead - compensate - 0.01 <= analysis["start"] < lead
+        assert lead + voiced < analysis["end"] <= lead + voiced + compensate + 0.1
+        assert not analysis["silent"] and not analysis["empty"]
+
+
+def test_clipping_is_detected_by_both(analyses):
+    config = ffmpegmulti.get_config()
+    for name, pair in analyses.items():
+        flagged = [analysis["clipped"] > config["quarantine_max_clipped"] for analysis in pair]
+        assert flagged == [name == "clipped.wav"] * 2, (name, pair)
+
+
+@pytest.mark.parametrize("backend", ffmpegmulti.ANALYSIS_BACKENDS)
+def test_too_short_to_measure_is_encoded_as_is(tmp_path, backend):
+    path = tmp_path / "short.wav"
+    # shorter than loudnorm's block, without any silence to trim
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", f"aevalsrc='0.5*{VOICE}':s=44100:d=0.3", str(path)], check=True)
+    config = dict(ffmpegmulti.get_config(), ffmpeg="ffmpeg", analysis_backend=backend)
+    analysis = asyncio.run(ffmpegmulti.analyze_file(path, config, False, False))
+    assert analysis["loudness"] is None
+    assert ffmpegmulti.quarantine_reason(analysis, config) is None
+
+
+@pytest.mark.parametrize("backend", ffmpegmulti.ANALYSIS_BACKENDS)
+def test_no_samples_is_empty(tmp_path, backend):
+    path = tmp_path / "empty.wav"
+    # a valid header without a single sample, nor a duration
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "anullsrc", "-t", "0", str(path)], check=True)
+    config = dict(ffmpegmulti.get_config(), ffmpeg="ffmpeg", analysis_backend=backend)
+    analysis = asyncio.run(ffmpegmulti.analyze_file(path, config, False, False))
+    assert analysis["empty"]
+    assert ffmpegmulti.quarantine_reason(analysis, config) == "no audio decoded"
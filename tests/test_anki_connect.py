@@ -0,0 +1,125 @@
+"""
+analyze_sentence_audio.AnkiConnect against a stub AnkiConnect server (http.server on a free port).
+
+The stub answers findNotes, notesInfo and multi like AnkiConnect's version 6 API, and records every
+request with the connection it came in on, so the tests can count the round trips and connections.
+"""
+
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import analyze_sentence_audio
+from analyze_sentence_audio import AnkiConnect, NoteCache, NOTES_INFO_PAGE, PAGES_PER_REQUEST
+
+NOTES = list(range(1, 2101))
+
+
+def note_info(note: int) -> dict:
+    # every third note has no sentence audio
+    value = "" if note % 3 == 0 else f"[sound:{note}.mp3]"
+    return {"noteId": note, "fields": {analyze_sentence_audio.AUDIO_FIELD: {"value": value, "order": 0}}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        self.connection_id = self.server.connections
+
+    def log_message(self, format, *args):
+        pass
+
+    def run_action(self, action: str, params: dict):
+        if action == "findNotes":
+            return NOTES
+        if action == "notesInfo":
+            self.server.notes_info_calls.append(len(params["notes"]))
+            return [note_info(note) for note in params["notes"]]
+        if action == "multi":
+            return [self.wrap(call["action"], call.get("params", {})) for call in params["actions"]]
+        raise ValueError(f"unsupported action {action}")
+
+    def wrap(self, action: str, params: dict) -> dict:
+        try:
+            return {"result": self.run_action(action, params), "error": None}
+        except ValueError as e:
+            return {"result": None, "error": str(e)}
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.connection_id, payload["action"]))
+        body = json.dumps(self.wrap(payload["action"], payload["params"])).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # like a server timing out an idle keep-alive connection: closed without a Connection: close header
+        self.close_connection = self.server.drop_connections
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.requests = []
+    server.notes_info_calls = []
+    server.drop_connections = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def anki(server):
+    client = AnkiConnect(f"http://127.0.0.1:{server.server_address[1]}", timeout=5)
+    yield client
+    client.close()
+
+
+def test_multi_runs_the_calls_in_one_request(server, anki):
+    results = anki.multi([("findNotes", {"query": "deck:current"}), ("notesInfo", {"notes": [4, 5]})])
+    assert results == [NOTES, [note_info(4), note_info(5)]]
+    assert server.requests == [(1, "multi")]
+
+
+def test_multi_raises_the_error_of_a_call(anki):
+    with pytest.raises(Exception, match="unsupported action"):
+        anki.multi([("findNotes", {"query": "deck:current"}), ("deleteDecks", {"decks": ["Default"]})])
+
+
+def test_notes_info_is_paged(server, anki):
+    per_request = NOTES_INFO_PAGE * PAGES_PER_REQUEST
+    batches = list(anki.notes_info(NOTES))
+    assert [len(batch) for batch in batches] == [per_request, per_request, len(NOTES) - 2 * per_request]
+    assert [info["noteId"] for batch in batches for info in batch] == NOTES
+    assert server.notes_info_calls == [NOTES_INFO_PAGE] * 8 + [len(NOTES) - 8 * NOTES_INFO_PAGE]
+    # all of it over a single keep-alive connection
+    assert server.requests == [(1, "multi")] * 3
+    assert anki.requests == 3
+
+
+def test_reconnects_when_the_server_closes_the_connection(server, anki):
+    server.drop_connections = True
+    for _ in range(3):
+        assert anki.invoke("findNotes", query="deck:current") == NOTES
+    assert server.requests == [(1, "findNotes"), (2, "findNotes"), (3, "findNotes")]
+    assert anki.requests == 3
+
+
+def test_sentence_audio_files_are_fetched_once(server, anki, tmp_path):
+    cache = NoteCache(str(tmp_path / "note_cache.sqlite"))
+    expected = [os.path.join(analyze_sentence_audio.MEDIA_DIR, f"{note}.mp3") for note in NOTES if note % 3]
+    assert analyze_sentence_audio.get_sentence_audio_files(anki, "mined", cache) == expected
+    fetched = len(server.notes_info_calls)
+    assert analyze_sentence_audio.get_sentence_audio_files(anki, "mined", cache) == expected
+    assert len(server.notes_info_calls) == fetched
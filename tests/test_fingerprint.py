@@ -0,0 +1,102 @@
+"""
+Recall of fingerprint.find_near_duplicates on re-encoded duplicates planted among random clips.
+
+The random clips are voiced, word length syllables (random pitch, formants and envelopes). A duplicate
+is the same clip after what a re-encode does to it: a different gain, lowpass, added noise,
+and a few ms of extra (or less) padding. With ffmpeg available, mp3 round trips are tested too.
+"""
+
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import fingerprint
+
+RATE = fingerprint.SAMPLE_RATE
+CLIPS = 400
+DUPLICATES = 60
+
+
+def random_clip(rng: np.random.Generator) -> np.ndarray:
+    duration = rng.uniform(0.6, 2.5)
+    t = np.arange(int(duration * RATE)) / RATE
+    clip = np.zeros_like(t)
+    # 1-4 syllables with their own pitch contour and formants
+    bounds = np.sort(rng.uniform(0, duration, rng.integers(0, 4)))
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, duration]):
+        part = (t >= start) & (t < end)
+        f0 = rng.uniform(90, 260) * (1 + rng.uniform(-0.2, 0.2) * (t[part] - start) / max(end - start, 1e-3))
+        phase = 2 * np.pi * np.cumsum(f0) / RATE
+        formants = rng.uniform([300, 900, 2000], [900, 2000, 2600])
+        for harmonic in range(1, 12):
+            frequency = harmonic * f0.mean()
+            gain = sum(np.exp(-((frequency - f) / 150) ** 2) for f in formants) + 0.05
+            clip[part] += gain / harmonic * np.sin(harmonic * phase)
+        clip[part] *= np.sin(np.pi * (t[part] - start) / (end - start)) ** rng.uniform(0.5, 2)
+    clip += 0.003 * rng.standard_normal(len(clip))
+    clip /= np.abs(clip).max()
+    pad = np.zeros(int(rng.uniform(0.05, 0.3) * RATE))
+    return np.concatenate([pad, clip, pad]).astype(np.float32)
+
+
+def simulated_reencode(clip: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    kernel = np.ones(rng.integers(1, 4))
+    gain = rng.uniform(0.4, 1.0)
+    out = np.convolve(clip, kernel / kernel.sum(), mode="same") * gain
+    # codec noise follows the signal level
+    out += gain * 10 ** (rng.uniform(-65, -50) / 20) * rng.standard_normal(len(out))
+    shift = int(rng.integers(-200, 200))
+    out = np.concatenate([np.zeros(shift), out]) if shift > 0 else out[-shift:]
+    return out.astype(np.float32)
+
+
+def mp3_reencode(clip: np.ndarray, ffmpeg: str) -> np.ndarray:
+    mp3 = subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "f32le", "-ar", str(RATE), "-ac", "1", "-i", "-",
+                          "-c:a", "libmp3lame", "-b:a", "32k", "-f", "mp3", "-"], input=clip.tobytes(), capture_output=True, check=True)
+    pcm = subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "mp3", "-i", "-",
+                          "-ar", str(RATE), "-ac", "1", "-f", "f32le", "-"], input=mp3.stdout, capture_output=True, check=True)
+    return np.frombuffer(pcm.stdout, dtype="<f4")
+
+
+def planted_recall(reencode) -> float:
+    rng = np.random.default_rng(13)
+    clips = [random_clip(rng) for _ in range(CLIPS)]
+    originals = rng.choice(CLIPS, DUPLICATES, replace=False)
+    clips += [reencode(clips[i], rng) for i in originals]
+    fingerprints = [fingerprint.fingerprint_pcm(clip) for clip in clips]
+
+    result = fingerprint.find_near_duplicates(fingerprints)
+    planted = {(int(i), CLIPS + k) for k, i in enumerate(originals)}
+    assert not result.skipped_buckets
+    return len(planted & set(result.pairs)) / len(planted)
+
+
+def test_recall_of_simulated_reencodes():
+    assert planted_recall(simulated_reencode) >= 0.95
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg with libmp3lame")
+def test_recall_of_mp3_reencodes():
+    assert planted_recall(lambda clip, rng: mp3_reencode(clip, "ffmpeg")) >= 0.95
+
+
+def test_pairs_are_compared_once(monkeypatch):
+    rng = np.random.default_rng(1)
+    clip = random_clip(rng)
+    # identical summaries collide in every band
+    fingerprints = [fingerprint.fingerprint_pcm(clip) for _ in range(3)] + [None]
+    compared = []
+    monkeypatch.setattr(fingerprint, "is_near_duplicate", lambda a, b: compared.append((a, b)) or True)
+    result = fingerprint.find_near_duplicates(fingerprints)
+    assert result.pairs == [(0, 1), (0, 2), (1, 2)]
+    assert len(compared) == 3
+
+
+def test_oversize_buckets_are_reported():
+    rng = np.random.default_rng(2)
+    clip = fingerprint.fingerprint_pcm(random_clip(rng))
+    result = fingerprint.find_near_duplicates([clip] * (fingerprint.MAX_BUCKET + 1))
+    assert result.pairs == []
+    assert result.skipped_buckets == [fingerprint.MAX_BUCKET + 1] * fingerprint.LSH_BANDS